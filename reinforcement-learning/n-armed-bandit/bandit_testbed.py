@@ -24,56 +24,94 @@ bandits.
 from __future__ import division, print_function
 
 import numpy as np
+import os
+import sys
+import json
+import shutil
 import functools
 import collections
+import multiprocessing
 from matplotlib import pyplot
 
-
-def multimax(lst):
-    """
-    Return the tuple (maxvalue, maxindex).  If there is more than one max
-    value, return one of them randomly.
-    """
-    maxvalue = np.max(lst)
-    maxindices = np.flatnonzero(lst == maxvalue)
-    random_index = np.random.randint(len(maxindices))
-    return (maxvalue, maxindices[random_index])
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from rlutils import multimax
 
 
 class BanditTestbed:
+    """
+    An n-armed bandit whose rewards are normally distributed around
+    `mean_rewards`.  With `block`, the reward noise is drawn `block` pulls
+    at a time and each pull is served from the block, instead of calling
+    `np.random.normal` on every pull.  With `seed`, the testbed draws from
+    its own `RandomState` instead of the global `np.random` state.
+    """
 
-    def __init__(self, narms, variance=1):
+    def __init__(self, narms, variance=1, block=None, seed=None):
         self.narms = narms
         self.variance = variance
-        self.mean_rewards = np.random.standard_normal(narms)
+        if seed is None:
+            self.random = np.random
+        else:
+            self.random = np.random.RandomState(seed)
+        self.mean_rewards = self.random.standard_normal(narms)
+        self.block = block
+        self.noise = np.empty(0)
+        self.nserved = 0
 
     def __str__(self):
         return 'narms = {0}\nmean_rewards = {1}'.format(self.narms,
                 self.mean_rewards)
 
     def play(self, arm):
-        assert(arm in range(self.narms))
+        assert(0 <= arm < self.narms)
         if self.variance == 0:
             reward = self.mean_rewards[arm]
+        elif self.block:
+            if self.nserved == len(self.noise):
+                self.noise = np.sqrt(self.variance) * \
+                        self.random.standard_normal(self.block)
+                self.nserved = 0
+            reward = self.mean_rewards[arm] + self.noise[self.nserved]
+            self.nserved += 1
         else:
-            reward = np.random.normal(self.mean_rewards[arm],
+            reward = self.random.normal(self.mean_rewards[arm],
                     np.sqrt(self.variance))
         return reward
 
 
-class Player:
+class Player(object):
+    """
+    Plays a single `BanditTestbed`.  The rewards and pulls are written
+    into preallocated buffers of length `nplays`, which may be rows of
+    larger matrices shared by many players (see `do_experiment`); the
+    buffers grow if more than `nplays` plays are made.
+    """
+
+    __slots__ = ('testbed', 'mean_estimates', 'npulls', 'rewards', 'pulls',
+            'nplayed', 'factor')
 
-    def __init__(self, testbed, factor=0.1, initial_estimates=0):
+    def __init__(self, testbed, factor=0.1, initial_estimates=0,
+            nplays=1000, rewards=None, pulls=None):
         self.testbed = testbed
         self.mean_estimates = np.zeros(testbed.narms) + initial_estimates
         self.npulls = np.zeros(testbed.narms)
-        self.reward_record = []
-        self.pull_record = []
+        self.rewards = np.empty(nplays) if rewards is None else rewards
+        self.pulls = np.empty(nplays, int) if pulls is None else pulls
+        self.nplayed = 0
         self.factor = factor
 
     def __str__(self):
         return 'mean_estimates = {0}'.format(self.mean_estimates)
 
+    @property
+    def reward_record(self):
+        return self.rewards[:self.nplayed]
+
+    @property
+    def pull_record(self):
+        return self.pulls[:self.nplayed]
+
     def choose_arm(self):
         # need to implement
         pass
@@ -81,8 +119,14 @@ class Player:
     def play(self):
         arm = self.choose_arm()
         reward = self.testbed.play(arm)
-        self.pull_record.append(arm)
-        self.reward_record.append(reward)
+        if self.nplayed == len(self.rewards):
+            self.rewards = np.concatenate((self.rewards,
+                np.empty(max(1, self.nplayed))))
+            self.pulls = np.concatenate((self.pulls,
+                np.empty(max(1, self.nplayed), int)))
+        self.pulls[self.nplayed] = arm
+        self.rewards[self.nplayed] = reward
+        self.nplayed += 1
 
         # incremental sample averaging
         self.mean_estimates[arm] += (1/(self.npulls[arm] + 1)) * (reward -
@@ -95,9 +139,11 @@ class EpsilonPlayer(Player):
 
     factor_name = r'\epsilon'
 
-    def __init__(self, testbed, factor=0.1, initial_estimates=0):
+    __slots__ = ()
+
+    def __init__(self, testbed, factor=0.1, initial_estimates=0, **kwargs):
         Player.__init__(self, testbed, factor,
-                initial_estimates=initial_estimates)
+                initial_estimates=initial_estimates, **kwargs)
 
     def choose_arm(self):
         if np.random.uniform() < self.factor: # explore
@@ -113,51 +159,321 @@ def random_weighted(weights):
     return cdf.searchsorted(np.random.uniform())
 
 
+def softmax(values, tau):
+    """
+    Gibbs distribution exp(values / tau), normalized along the last axis.
+    The max is subtracted first, so small `tau` can't overflow.
+    """
+    scaled = values / tau
+    N = np.exp(scaled - scaled.max(-1)[..., np.newaxis])
+    return N / N.sum(-1)[..., np.newaxis]
+
+
+def softmax_choice(values, tau):
+    """
+    Choose an index along the last axis of `values` with probability
+    `softmax(values, tau)`, for a vector or for every row of a matrix at
+    once.  Uses the Gumbel-max trick, argmax(values / tau + Gumbel noise),
+    which needs no exponentials, normalization or cumulative sums.
+    """
+    return np.argmax(values / tau + np.random.gumbel(size=np.shape(values)),
+            -1)
+
+
 class SoftmaxPlayer(Player):
 
     factor_name = r'\tau'
 
-    def __init__(self, testbed, factor=0.1, initial_estimates=0):
+    __slots__ = ()
+
+    def __init__(self, testbed, factor=0.1, initial_estimates=0, **kwargs):
         Player.__init__(self, testbed, factor=factor,
-                initial_estimates=initial_estimates)
+                initial_estimates=initial_estimates, **kwargs)
 
     def choose_arm(self):
-        N = np.exp(self.mean_estimates / self.factor)
-        return random_weighted(N)
+        return softmax_choice(self.mean_estimates, self.factor)
+
+
+class BatchBanditTestbed:
+    """
+    A stack of `ntasks` independent n-armed bandits, played in lockstep.
+    Row `i` of `mean_rewards` is the testbed for task `i`.
+    """
+
+    def __init__(self, ntasks, narms, variance=1, mean_rewards=None):
+        self.ntasks = ntasks
+        self.narms = narms
+        self.variance = variance
+        if mean_rewards is None:
+            mean_rewards = np.random.standard_normal((ntasks, narms))
+        self.mean_rewards = mean_rewards
+        self.tasks = np.arange(ntasks)
+
+    def __str__(self):
+        return 'ntasks = {0}\nnarms = {1}\nmean_rewards = {2}'.format(
+                self.ntasks, self.narms, self.mean_rewards)
+
+    def play(self, arms):
+        """
+        Pull arm `arms[i]` of task `i` for every task, and return the
+        vector of rewards.
+        """
+        reward = self.mean_rewards[self.tasks, arms]
+        if self.variance != 0:
+            reward = reward + np.sqrt(self.variance) * \
+                    np.random.standard_normal(self.ntasks)
+        return reward
+
+
+class BatchPlayer:
+    """
+    Plays every task of a `BatchBanditTestbed` at once, choosing arms
+    with `policy`.  The estimates and pull counts are `(ntasks, narms)`
+    arrays and the records are `(ntasks, nplays)` arrays, so
+    `reward_record` and `pull_record` stack exactly like the records of
+    the equivalent list of `Player`s.
+    """
+
+    def __init__(self, testbed, policy, initial_estimates=0, nplays=1000):
+        self.testbed = testbed
+        shape = (testbed.ntasks, testbed.narms)
+        self.mean_estimates = np.zeros(shape) + initial_estimates
+        self.npulls = np.zeros(shape)
+        self.reward_record = np.empty((testbed.ntasks, nplays))
+        self.pull_record = np.empty((testbed.ntasks, nplays), int)
+        self.nplayed = 0
+        self.policy = policy
+        self.factor = policy.factor
+        self.factor_name = policy.factor_name
+        policy.reset(self)
+
+    def __str__(self):
+        return 'mean_estimates = {0}'.format(self.mean_estimates)
+
+    def play(self):
+        arms = self.policy.choose_arms(self)
+        rewards = self.testbed.play(arms)
+        self.pull_record[:, self.nplayed] = arms
+        self.reward_record[:, self.nplayed] = rewards
+        self.nplayed += 1
+
+        # incremental sample averaging, one arm per task
+        tasks = self.testbed.tasks
+        self.mean_estimates[tasks, arms] += (1/(self.npulls[tasks, arms] +
+            1)) * (rewards - self.mean_estimates[tasks, arms])
+
+        self.npulls[tasks, arms] += 1
+        self.policy.update(self, arms, rewards)
+
+
+class Policy:
+    """
+    Chooses one arm for every task of a `BatchPlayer` at once, from the
+    player's `(ntasks, narms)` arrays.  `factor` is the policy's
+    parameter, written `factor_name` in plots.  A policy that keeps
+    per-task arrays of its own creates them in `reset`, lists their
+    attribute names in `state_names` and updates them in `update`.
+
+    Policy classes can be passed to `do_experiment` and `experiment_2_1`
+    in place of a `Player` class.
+    """
+
+    factor_name = None
+    state_names = ()
+
+    def __init__(self, factor=0.1):
+        self.factor = factor
+
+    def reset(self, player):
+        pass
+
+    def choose_arms(self, player):
+        # need to implement
+        pass
+
+    def update(self, player, arms, rewards):
+        pass
+
+
+class EpsilonGreedyPolicy(Policy):
+
+    factor_name = EpsilonPlayer.factor_name
+
+    def choose_arms(self, player):
+        ntasks, narms = player.mean_estimates.shape
+        value, arms = multimax(player.mean_estimates, axis=1)
+        explore = np.random.uniform(size=ntasks) < self.factor
+        arms[explore] = np.random.randint(narms, size=explore.sum())
+        return arms
+
+
+class SoftmaxPolicy(Policy):
+
+    factor_name = SoftmaxPlayer.factor_name
+
+    def choose_arms(self, player):
+        return softmax_choice(player.mean_estimates, self.factor)
+
+
+class UCB1Policy(Policy):
+    """
+    Upper-confidence-bound action selection: the greedy arm of
+    mean_estimates + c * sqrt(ln(t) / npulls), with c = `factor`.
+    Arms that have never been pulled are tried first.
+    """
+
+    factor_name = 'c'
+
+    def choose_arms(self, player):
+        t = player.npulls.sum(1)[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bonus = self.factor * np.sqrt(np.log(t) / player.npulls)
+        bonus[player.npulls == 0] = np.inf
+        return multimax(player.mean_estimates + bonus, axis=1)[1]
+
+
+class GradientBanditPolicy(Policy):
+    """
+    Gradient bandit: arms are chosen by `softmax` over per-task
+    preferences, which follow the stochastic gradient of the expected
+    reward with step size alpha = `factor`, using each task's average
+    reward as the baseline.
+    """
+
+    factor_name = r'\alpha'
+    state_names = ('preferences', 'baseline')
+
+    def reset(self, player):
+        self.preferences = np.zeros(player.mean_estimates.shape)
+        self.baseline = np.zeros(player.mean_estimates.shape[0])
+
+    def choose_arms(self, player):
+        return softmax_choice(self.preferences, 1)
+
+    def update(self, player, arms, rewards):
+        tasks = player.testbed.tasks
+        step = self.factor * (rewards - self.baseline)
+        self.preferences -= step[:, np.newaxis] * softmax(self.preferences, 1)
+        self.preferences[tasks, arms] += step
+        self.baseline += (1/player.npulls.sum(1)) * (rewards - self.baseline)
+
+
+def do_batch_experiment(PolicyClass=EpsilonGreedyPolicy, ntasks=2000,
+        narms=10, nplays=1000, factor=0.1, variance=1, streaming=False,
+        batch_size=2000):
+    """
+    Like `do_experiment`, but tasks are played in lockstep by a
+    `BatchPlayer` using a `PolicyClass` policy.  Returns a one-element
+    list, which the statistics functions treat like the list of per-task
+    `Player`s.  With `streaming`, tasks are played `batch_size` at a time
+    and folded into an `ExperimentSummary`, which is returned instead.
+    """
+    def batch(ntasks):
+        print(PolicyClass.factor_name + ':', factor, 'Tasks:', ntasks,
+                'started')
+        testbed = BatchBanditTestbed(ntasks, narms, variance)
+        player = BatchPlayer(testbed, PolicyClass(factor), nplays=nplays)
+        for j in xrange(nplays):
+            player.play()
+        return player
+
+    if not streaming:
+        player = batch(ntasks)
+        return Players([player], player.reward_record, player.pull_record)
+
+    summary = ExperimentSummary(PolicyClass.factor_name, nplays)
+    for start in xrange(0, ntasks, batch_size):
+        summary.add_player(batch(min(batch_size, ntasks - start)))
+    return summary
 
 
 def do_experiment(PlayerClass=EpsilonPlayer, ntasks=2000, narms=10,
-        nplays=1000, factor=0.1, variance=1):
+        nplays=1000, factor=0.1, variance=1, streaming=False, block=None):
+    """
+    Play `ntasks` tasks of `nplays` plays each, and return the list of
+    players.  With `streaming`, each player is folded into an
+    `ExperimentSummary` as soon as its task is done, and the summary is
+    returned instead.  `block` is passed on to each `BanditTestbed`.
+    """
+    if issubclass(PlayerClass, Policy):
+        return do_batch_experiment(PlayerClass, ntasks=ntasks, narms=narms,
+                nplays=nplays, factor=factor, variance=variance,
+                streaming=streaming)
 
-    def task(n):
+    def task(n, rewards, pulls):
         if n % 100 == 0:
             print(PlayerClass.factor_name + ':', factor, 'Task:', n, 'started')
-        testbed = BanditTestbed(narms, variance)
-        player = PlayerClass(testbed, factor=factor)
+        testbed = BanditTestbed(narms, variance, block=block)
+        player = PlayerClass(testbed, factor=factor, rewards=rewards,
+                pulls=pulls)
         for j in xrange(nplays):
             player.play()
         return player
 
-    return [task(n) for n in xrange(ntasks)]
+    if not streaming:
+        # each player records straight into its row of the matrices
+        reward_matrix = np.empty((ntasks, nplays))
+        pull_matrix = np.empty((ntasks, nplays), int)
+        return Players([task(n, reward_matrix[n], pull_matrix[n])
+            for n in xrange(ntasks)], reward_matrix, pull_matrix)
+
+    # a finished player is folded in right away, so its buffers are reused
+    summary = ExperimentSummary(PlayerClass.factor_name, nplays)
+    rewards = np.empty(nplays)
+    pulls = np.empty(nplays, int)
+    for n in xrange(ntasks):
+        summary.add_player(task(n, rewards, pulls))
+    return summary
+
+
+class Players(list):
+    """
+    The list of players returned by `do_experiment`, along with the
+    `(ntasks, nplays)` reward and pull matrices that their records are
+    views of.
+    """
+
+    def __init__(self, players, reward_matrix, pull_matrix):
+        list.__init__(self, players)
+        self.reward_matrix = reward_matrix
+        self.pull_matrix = pull_matrix
+
+
+def record_matrices(players):
+    """
+    Return the `(ntasks, nplays)` reward and pull matrices of a list of
+    players, without copying when they are `Players` from
+    `do_experiment`.
+    """
+    if isinstance(players, Players):
+        return (players.reward_matrix, players.pull_matrix)
+    return (np.vstack([p.reward_record for p in players]),
+            np.vstack([p.pull_record for p in players]))
 
 
 def mean_reward(players):
-    rewards = np.vstack(p.reward_record for p in players)
+    if isinstance(players, ExperimentSummary):
+        return players.reward_mean
+    rewards, pulls = record_matrices(players)
     return rewards.mean(0)
 
 
 def optimal_pull(player):
-    return np.argmax(player.testbed.mean_rewards)
+    """
+    The optimal arm of `player`'s testbed, or a vector of optimal arms,
+    one per task, for a `BatchPlayer`.
+    """
+    return np.argmax(player.testbed.mean_rewards, -1)
 
 def optimal_counts(players):
-    pull_matrix = np.vstack(p.pull_record for p in players)
+    if isinstance(players, ExperimentSummary):
+        return (players.optimal_count, players.ntasks)
+    rewards, pull_matrix = record_matrices(players)
     ntasks, nplays = pull_matrix.shape
-    optimal_plays = [optimal_pull(p) for p in players]
+    optimal_plays = np.hstack([optimal_pull(p) for p in players])
     optimal_column = np.reshape(optimal_plays, (ntasks, 1))
     assert(optimal_column.shape == (ntasks, 1))
-    optimal_matrix = np.tile(optimal_column, (1, nplays))
-    assert(optimal_matrix.shape == (ntasks, nplays))
-    optimal_count = np.sum((pull_matrix == optimal_matrix), 0)
+    optimal_count = np.sum((pull_matrix == optimal_column), 0)
     assert(optimal_count.size == nplays)
     return (optimal_count, ntasks)
 
@@ -166,20 +482,530 @@ def percent_optimal_action(players):
     return 100 * noptimal / ntasks
 
 
+class ExperimentSummary:
+    """
+    Per-play statistics over a set of tasks: the mean and sum of squared
+    deviations (Welford's M2) of the rewards, and the number of optimal
+    pulls at each play.  Tasks are folded in as they finish, so memory is
+    O(nplays) however many tasks are run.  Summaries of disjoint sets of
+    tasks can be merged, and `mean_reward`, `percent_optimal_action` and
+    `plot_2_1` accept a summary in place of a list of players.
+    """
+
+    def __init__(self, factor_name, nplays):
+        self.factor_name = factor_name
+        self.ntasks = 0
+        self.reward_mean = np.zeros(nplays)
+        self.reward_m2 = np.zeros(nplays)
+        self.optimal_count = np.zeros(nplays, int)
+
+    def __str__(self):
+        return 'ntasks = {0}\nnplays = {1}'.format(self.ntasks,
+                self.reward_mean.size)
+
+    @classmethod
+    def from_players(cls, players):
+        summary = cls(players[0].factor_name,
+                np.shape(players[0].reward_record)[-1])
+        for p in players:
+            summary.add_player(p)
+        return summary
+
+    def combine(self, ntasks, reward_mean, reward_m2):
+        """
+        Fold in the reward statistics of `ntasks` other tasks, using Chan
+        et al.'s pairwise update.  For a single task this is exactly
+        Welford's update.
+        """
+        total = self.ntasks + ntasks
+        delta = reward_mean - self.reward_mean
+        self.reward_mean += delta * (ntasks / total)
+        self.reward_m2 += reward_m2 + delta**2 * (self.ntasks * ntasks / total)
+        self.ntasks = total
+
+    def add(self, rewards, optimal):
+        """
+        Fold in a block of tasks, given as `(ntasks, nplays)` matrices of
+        rewards and of whether each pull was optimal.
+        """
+        rewards = np.atleast_2d(rewards)
+        block_mean = rewards.mean(0)
+        self.combine(rewards.shape[0], block_mean,
+                ((rewards - block_mean)**2).sum(0))
+        self.optimal_count += np.atleast_2d(optimal).sum(0)
+
+    def add_player(self, player):
+        """Fold in the records of a `Player` or `BatchPlayer`."""
+        optimal_column = np.reshape(optimal_pull(player), (-1, 1))
+        self.add(player.reward_record,
+                np.atleast_2d(player.pull_record) == optimal_column)
+
+    def merge(self, other):
+        """Fold in `other`, a summary of different tasks."""
+        assert(self.reward_mean.size == other.reward_mean.size)
+        self.combine(other.ntasks, other.reward_mean, other.reward_m2)
+        self.optimal_count += other.optimal_count
+        return self
+
+    def reward_variance(self):
+        """Sample variance of the reward across tasks, at each play."""
+        return self.reward_m2 / (self.ntasks - 1)
+
+
+def factor_name(result):
+    """The factor name of a list of players or an `ExperimentSummary`."""
+    if isinstance(result, ExperimentSummary):
+        return result.factor_name
+    return result[0].factor_name
+
+
+def resize_npy(filename, shape, dtype=float):
+    """
+    Return the `.npy` file `filename` memory-mapped read-write with the
+    given `shape`, creating it full of zeros if it doesn't exist.  If it
+    has a different shape, it is rewritten with the old contents in the
+    leading corner and zeros elsewhere.
+    """
+    shape = tuple(shape)
+    if not os.path.exists(filename):
+        return np.lib.format.open_memmap(filename, 'w+', dtype, shape)
+    old = np.load(filename, mmap_mode='r')
+    if old.shape != shape:
+        new = np.lib.format.open_memmap(filename + '.tmp', 'w+', old.dtype,
+                shape)
+        new[tuple(slice(0, n) for n in old.shape)] = old
+        new.flush()
+        del old, new
+        os.rename(filename + '.tmp', filename)
+    return np.load(filename, mmap_mode='r+')
+
+
+# the batched policy that plays like each player class
+PLAYER_POLICIES = {EpsilonPlayer: EpsilonGreedyPolicy,
+                   SoftmaxPlayer: SoftmaxPolicy}
+
+
+class BanditRun:
+    """
+    A batched run of one policy and factor, stored in `directory` as
+    memory-mapped `.npy` files: every task's true means, estimates, pull
+    counts and policy state, the per-play reward and optimal-pull curves
+    of an `ExperimentSummary`, and the `np.random` state to continue
+    from.  `extend` adds plays or tasks to the stored run, computing only
+    the new part, and `summary` maps the curves for `plot_2_1`.
+
+    `PolicyClass` may also be `EpsilonPlayer` or `SoftmaxPlayer`, which
+    are run as the matching `Policy`.
+
+    `extend` works on copies of the files in a staging subdirectory and
+    only moves them into place once they are all written, so an
+    interrupted extend leaves the run as it was before.  A run whose
+    files were being moved into place when it was interrupted is
+    finished when it is next opened.
+    """
+
+    def __init__(self, directory, PolicyClass=EpsilonGreedyPolicy,
+            factor=0.1, narms=10, variance=1, seed=0):
+        PolicyClass = PLAYER_POLICIES.get(PolicyClass, PolicyClass)
+        assert issubclass(PolicyClass, Policy), \
+                "BanditRun needs a Policy class, not {0}".format(
+                        PolicyClass.__name__)
+        self.directory = directory
+        self.working_directory = directory
+        self.PolicyClass = PolicyClass
+        self.recover()
+        info = dict(policy=PolicyClass.__name__, factor=factor, narms=narms,
+                variance=variance)
+        if os.path.exists(self.filename('run', '.json')):
+            with open(self.filename('run', '.json')) as f:
+                self.info = json.load(f)
+            for key in info:
+                assert(self.info[key] == info[key])
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.info = dict(info, ntasks=0, nplays=0)
+            self.save_rng_state(np.random.RandomState(seed).get_state())
+            self.save_info()
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.directory, self.info)
+
+    def filename(self, name, extension='.npy'):
+        return os.path.join(self.working_directory, name + extension)
+
+    def staging(self, name=''):
+        return os.path.join(self.directory, 'extend.tmp', name)
+
+    def recover(self):
+        """
+        Finish moving a staged extend into place if it was completely
+        written, and throw it away otherwise.
+        """
+        if os.path.exists(self.staging('complete')):
+            self.commit()
+        elif os.path.isdir(self.staging()):
+            shutil.rmtree(self.staging())
+
+    def commit(self):
+        """Move the files of a completely written extend into place."""
+        for name in os.listdir(self.staging()):
+            if name != 'complete':
+                os.rename(self.staging(name),
+                        os.path.join(self.directory, name))
+        os.remove(self.staging('complete'))
+        os.rmdir(self.staging())
+
+    def save_info(self):
+        with open(self.filename('run', '.json'), 'w') as f:
+            json.dump(self.info, f)
+
+    def save_rng_state(self, state):
+        name, keys, pos, has_gauss, cached_gaussian = state
+        np.save(self.filename('rng_keys'), keys)
+        with open(self.filename('rng', '.json'), 'w') as f:
+            json.dump([name, pos, has_gauss, cached_gaussian], f)
+
+    def load_rng_state(self):
+        with open(self.filename('rng', '.json')) as f:
+            name, pos, has_gauss, cached_gaussian = json.load(f)
+        return (str(name), np.load(self.filename('rng_keys')), pos, has_gauss,
+                cached_gaussian)
+
+    def state_names(self):
+        """Names of the per-task arrays, one `(ntasks, ...)` file each."""
+        return ['mean_rewards', 'mean_estimates', 'npulls'] + \
+                ['policy_' + name for name in self.PolicyClass.state_names]
+
+    def player(self, nplays):
+        """
+        A `BatchPlayer` for the stored tasks whose state arrays are the
+        mapped files, with record buffers for `nplays` more plays.
+        """
+        mean_rewards = np.load(self.filename('mean_rewards'), mmap_mode='r')
+        testbed = BatchBanditTestbed(self.info['ntasks'], self.info['narms'],
+                self.info['variance'], mean_rewards=mean_rewards)
+        player = BatchPlayer(testbed, self.PolicyClass(self.info['factor']),
+                nplays=nplays)
+        player.mean_estimates = np.load(self.filename('mean_estimates'),
+                mmap_mode='r+')
+        player.npulls = np.load(self.filename('npulls'), mmap_mode='r+')
+        for name in self.PolicyClass.state_names:
+            setattr(player.policy, name, np.load(
+                self.filename('policy_' + name), mmap_mode='r+'))
+        return player
+
+    def summary(self, mode='r'):
+        """The stored curves, as an `ExperimentSummary` of mapped arrays."""
+        summary = ExperimentSummary(self.PolicyClass.factor_name, 0)
+        summary.ntasks = self.info['ntasks']
+        for name in ('reward_mean', 'reward_m2', 'optimal_count'):
+            setattr(summary, name, np.load(self.filename(name),
+                mmap_mode=mode))
+        return summary
+
+    def extend(self, ntasks=None, nplays=None):
+        """
+        Grow the run to at least `ntasks` tasks of `nplays` plays: first
+        the stored tasks are played on from where they stopped, then any
+        new tasks are played from the start and merged in.
+        """
+        if self.stage(ntasks, nplays):
+            self.commit()
+        return self
+
+    def stage(self, ntasks=None, nplays=None):
+        """
+        Write the files of the extended run to the staging directory,
+        ending with its 'complete' marker.  Returns whether there was
+        anything to extend.  The run plays from its own stored `np.random`
+        state, and the caller's state is restored afterwards.
+        """
+        old_ntasks, old_nplays = self.info['ntasks'], self.info['nplays']
+        ntasks = max(ntasks, old_ntasks)
+        nplays = max(nplays, old_nplays)
+        if (ntasks, nplays) == (old_ntasks, old_nplays):
+            return False
+        if os.path.isdir(self.staging()):
+            shutil.rmtree(self.staging())
+        os.makedirs(self.staging())
+        for name in os.listdir(self.directory):
+            if os.path.isfile(os.path.join(self.directory, name)):
+                shutil.copy(os.path.join(self.directory, name),
+                        self.staging(name))
+        self.working_directory = self.staging()
+        global_state = np.random.get_state()
+        try:
+            self.extend_files(ntasks, nplays)
+        finally:
+            self.working_directory = self.directory
+            np.random.set_state(global_state)
+        open(self.staging('complete'), 'w').close()
+        return True
+
+    def extend_files(self, ntasks, nplays):
+        old_ntasks, old_nplays = self.info['ntasks'], self.info['nplays']
+        np.random.set_state(self.load_rng_state())
+        if ntasks > old_ntasks or old_ntasks > 0:
+            resize_npy(self.filename('reward_mean'), (nplays,))
+            resize_npy(self.filename('reward_m2'), (nplays,))
+            resize_npy(self.filename('optimal_count'), (nplays,), int)
+
+        if old_ntasks > 0 and nplays > old_nplays:
+            print(self.PolicyClass.factor_name + ':', self.info['factor'],
+                    'Plays:', old_nplays, 'to', nplays, 'started')
+            player = self.player(nplays - old_nplays)
+            for j in xrange(nplays - old_nplays):
+                player.play()
+            block = ExperimentSummary(self.PolicyClass.factor_name,
+                    nplays - old_nplays)
+            block.add_player(player)
+            curves = self.summary('r+')
+            curves.reward_mean[old_nplays:] = block.reward_mean
+            curves.reward_m2[old_nplays:] = block.reward_m2
+            curves.optimal_count[old_nplays:] = block.optimal_count
+            del player, curves
+
+        if ntasks > old_ntasks:
+            block = do_batch_experiment(self.PolicyClass,
+                    ntasks=ntasks - old_ntasks, narms=self.info['narms'],
+                    nplays=nplays, factor=self.info['factor'],
+                    variance=self.info['variance'])
+            player = block[0]
+            curves = self.summary('r+')
+            curves.merge(ExperimentSummary.from_players(block))
+            arrays = [player.testbed.mean_rewards, player.mean_estimates,
+                    player.npulls] + [getattr(player.policy, name)
+                            for name in self.PolicyClass.state_names]
+            for name, array in zip(self.state_names(), arrays):
+                mapped = resize_npy(self.filename(name),
+                        (ntasks,) + array.shape[1:], array.dtype)
+                mapped[old_ntasks:] = array
+                del mapped
+            del player, block, curves
+
+        self.save_rng_state(np.random.get_state())
+        self.info.update(ntasks=ntasks, nplays=nplays)
+        self.save_info()
+
+
 ## Tests
 
-def test_multimax():
-    foo = np.array([1, 2, 3, 4, 5, 6])
-    assert(multimax(foo) == (6, 5))
+def test_batch_player():
+    np.random.seed(0)
+    players = do_experiment(EpsilonGreedyPolicy, ntasks=50, nplays=20)
+    assert(len(players) == 1)
+    player = players[0]
+    assert(player.reward_record.shape == (50, 20))
+    assert((player.npulls.sum(1) == 20).all())
+    assert(mean_reward(players).shape == (20,))
+    percent = percent_optimal_action(players)
+    assert(percent.shape == (20,))
+    assert(((0 <= percent) & (percent <= 100)).all())
 
-    foo = np.array([1, 6, 3, 6, 5, 3])
-    (rvalue, rindex) = multimax(foo)
-    print(rindex)
-    assert(rvalue == 6)
-    assert(rindex == 1 or rindex == 3)
-    (rvalue, rindex) = multimax(foo)
-    print(rindex)
-    assert(rindex == 1 or rindex == 3)
+    # with no noise, every pulled arm's estimate is exact
+    testbed = BatchBanditTestbed(5, 10, variance=0)
+    player = BatchPlayer(testbed, EpsilonGreedyPolicy(0), nplays=3)
+    for j in xrange(3):
+        player.play()
+    tasks = testbed.tasks[:, np.newaxis]
+    assert((player.mean_estimates[tasks, player.pull_record] ==
+            testbed.mean_rewards[tasks, player.pull_record]).all())
+
+
+def test_parallel_sweep():
+    sweep = functools.partial(experiment_2_1, ntasks=30, nplays=20,
+            factors=(0, 0.1), parallel=True, seed=1, shard_size=8)
+    serial = sweep(processes=1)
+    pooled = sweep(processes=3)
+    assert(list(serial) == [0, 0.1])
+    for f in serial:
+        assert(serial[f].ntasks == 30)
+        assert((mean_reward(serial[f]) == mean_reward(pooled[f])).all())
+        assert((percent_optimal_action(serial[f]) ==
+                percent_optimal_action(pooled[f])).all())
+
+
+def test_streaming_summary():
+    for PlayerClass in (EpsilonPlayer, EpsilonGreedyPolicy):
+        np.random.seed(2)
+        players = do_experiment(PlayerClass, ntasks=25, nplays=15)
+        np.random.seed(2)
+        summary = do_experiment(PlayerClass, ntasks=25, nplays=15,
+                streaming=True)
+        rewards = np.vstack([p.reward_record for p in players])
+        assert(summary.ntasks == 25)
+        assert(np.allclose(mean_reward(summary), mean_reward(players)))
+        assert(np.allclose(summary.reward_variance(), rewards.var(0, ddof=1)))
+        assert((percent_optimal_action(summary) ==
+                percent_optimal_action(players)).all())
+
+
+def test_player_buffers():
+    np.random.seed(3)
+    players = do_experiment(EpsilonPlayer, ntasks=10, nplays=12)
+    assert(isinstance(players, Players))
+    rewards, pulls = record_matrices(players)
+    assert(rewards is players.reward_matrix)
+    assert(np.may_share_memory(players[4].reward_record, rewards))
+    assert((players[4].pull_record == pulls[4]).all())
+    assert(not hasattr(players[0], '__dict__'))
+
+    # a standalone player grows its buffers past nplays
+    player = SoftmaxPlayer(BanditTestbed(10), nplays=2)
+    for j in xrange(5):
+        player.play()
+    assert(player.reward_record.shape == (5,))
+    assert(player.npulls.sum() == 5)
+
+
+def test_reward_blocks():
+    # a seeded testbed is reproducible
+    rewards = []
+    for j in xrange(2):
+        testbed = BanditTestbed(10, variance=4, block=64, seed=5)
+        rewards.append([testbed.play(3) for x in xrange(1000)])
+    assert(rewards[0] == rewards[1])
+
+    # and keeps the reward distribution of the unblocked testbed
+    rewards = np.array(rewards[0])
+    assert(abs(rewards.mean() - testbed.mean_rewards[3]) < 0.2)
+    assert(abs(rewards.std() - 2) < 0.2)
+
+
+def test_softmax_choice():
+    np.random.seed(4)
+    values = np.array([[0., 1., 2.], [2., 2., 0.]])
+    choices = np.array([softmax_choice(values, 1) for x in xrange(20000)])
+    for row in xrange(2):
+        frequencies = np.bincount(choices[:, row], minlength=3) / 20000
+        assert(np.allclose(frequencies, softmax(values, 1)[row], atol=0.02))
+
+    # small taus neither overflow nor return nans
+    values = np.array([5., 10., 20.])
+    assert((softmax(values, 0.01) == [0, 0, 1]).all())
+    assert(softmax_choice(values, 0.01) == 2)
+    summary = do_experiment(SoftmaxPolicy, ntasks=20, nplays=50,
+            factor=0.01, streaming=True)
+    assert(np.isfinite(mean_reward(summary)).all())
+
+
+def test_policies():
+    np.random.seed(6)
+    policies = (EpsilonGreedyPolicy, SoftmaxPolicy, UCB1Policy,
+            GradientBanditPolicy)
+    for PolicyClass in policies:
+        results = experiment_2_1(PolicyClass, ntasks=30, nplays=40,
+                factors=(0.1, 1))
+        assert(factor_name(results[1]) == PolicyClass.factor_name)
+        assert(mean_reward(results[0.1]).shape == (40,))
+        assert(np.isfinite(mean_reward(results[1])).all())
+
+    # UCB1 tries every arm once before exploiting
+    testbed = BatchBanditTestbed(8, 10)
+    player = BatchPlayer(testbed, UCB1Policy(2), nplays=10)
+    for j in xrange(10):
+        player.play()
+    assert((player.npulls == 1).all())
+
+    # gradient steps move probability between arms, so preferences sum to 0
+    player = BatchPlayer(testbed, GradientBanditPolicy(0.1), nplays=20)
+    for j in xrange(20):
+        player.play()
+    assert(np.allclose(player.policy.preferences.sum(1), 0))
+    assert(np.allclose(player.policy.baseline, player.reward_record.mean(1)))
+
+
+def test_bandit_run():
+    import tempfile
+    import shutil
+    directory = tempfile.mkdtemp()
+    try:
+        for PolicyClass in (EpsilonGreedyPolicy, GradientBanditPolicy):
+            whole = BanditRun(os.path.join(directory, 'whole'), PolicyClass,
+                    seed=7).extend(12, 30)
+            parts = BanditRun(os.path.join(directory, 'parts'), PolicyClass,
+                    seed=7).extend(12, 10)
+            parts.extend(nplays=30)
+            assert(parts.info['nplays'] == 30)
+            assert((parts.summary().reward_mean ==
+                    whole.summary().reward_mean).all())
+            assert((parts.summary().optimal_count ==
+                    whole.summary().optimal_count).all())
+
+            # added tasks merge into the stored curves
+            reopened = BanditRun(os.path.join(directory, 'parts'),
+                    PolicyClass, seed=7).extend(20, 30)
+            summary = reopened.summary()
+            assert(summary.ntasks == 20)
+            assert(np.load(reopened.filename('npulls')).shape == (20, 10))
+            assert((np.load(reopened.filename('npulls')).sum(1) == 30).all())
+            assert(summary.optimal_count.max() <= 20)
+            shutil.rmtree(os.path.join(directory, 'whole'))
+            shutil.rmtree(os.path.join(directory, 'parts'))
+
+        # an interrupted extend is rolled back, or finished if it got as
+        # far as moving its files into place
+        whole = BanditRun(os.path.join(directory, 'whole'),
+                seed=7).extend(12, 30)
+        for finish in (False, True):
+            name = os.path.join(directory, 'interrupted')
+            BanditRun(name, seed=7).extend(12, 10).stage(nplays=30)
+            if not finish:
+                os.remove(os.path.join(name, 'extend.tmp', 'complete'))
+            run = BanditRun(name, seed=7)
+            assert(not os.path.exists(run.staging()))
+            assert(run.info['nplays'] == (30 if finish else 10))
+            run.extend(nplays=30)
+            assert((run.summary().reward_mean ==
+                    whole.summary().reward_mean).all())
+            assert((np.load(run.filename('npulls')).sum(1) == 30).all())
+            shutil.rmtree(name)
+
+        # stored runs leave the caller's generator where it was
+        np.random.seed(11)
+        expected = np.random.uniform()
+        np.random.seed(11)
+        results = experiment_2_1(UCB1Policy, ntasks=10, nplays=15,
+                factors=(1, 2), directory=directory)
+        assert(np.random.uniform() == expected)
+        assert(mean_reward(results[2]).shape == (15,))
+        assert(isinstance(results[2].reward_mean, np.memmap))
+
+        # player classes are run as the matching policy
+        results = experiment_exercise_2_1(ntasks=5, nplays=10,
+                directory=os.path.join(directory, 'exercise'))
+        assert(list(results) == [0, 0.01, 0.1, 0.5])
+        assert(factor_name(results[0.1]) == EpsilonGreedyPolicy.factor_name)
+        assert(mean_reward(results[0.1]).shape == (10,))
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_successive_halving():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        best, history = successive_halving(EpsilonGreedyPolicy,
+                factors=(1, 0.9, 0.1, 0.8), ntasks=40, nplays=50,
+                play_growth=1.5, directory=directory, seed=8)
+        assert(best == 0.1)
+        assert([len(scores) for scores in history] == [4, 2])
+        assert(max(history[-1], key=history[-1].get) == best)
+
+        # survivors are extended with more tasks and plays, and the
+        # others are left as they were after the round that dropped them
+        sizes = dict((f, BanditRun(os.path.join(directory,
+            'factor_{0}'.format(f)), factor=f).info) for f in
+            (1, 0.9, 0.1, 0.8))
+        assert(sizes[0.1]['ntasks'] == 80 and sizes[0.1]['nplays'] == 75)
+        assert(sorted((info['ntasks'], info['nplays']) for info in
+            sizes.values()) == [(40, 50), (40, 50), (80, 75), (80, 75)])
+    finally:
+        shutil.rmtree(directory)
+
+    # nothing is run to score a lone factor
+    assert(successive_halving(factors=(0.3,)) == (0.3, []))
 
 
 def test_random_weighted():
@@ -190,22 +1016,152 @@ def test_random_weighted():
 
 ## Recreate Figure 2.1 from Sutton and Barto with several experiments
 
+def do_shard(shard):
+    """
+    Run one shard of a parallel sweep and return its
+    `ExperimentSummary`.  `shard` is a tuple of `do_experiment` keyword
+    arguments and the seed for the shard.
+    """
+    kwargs, seed = shard
+    np.random.seed(seed)
+    return do_experiment(streaming=True, **kwargs)
+
+
+def parallel_sweep(PlayerClass=EpsilonPlayer, ntasks=2000, narms=10,
+        nplays=1000, variance=1, factors=(0, 0.01, 0.1, 0.5), seed=0,
+        shard_size=100, processes=None, block=None):
+    """
+    Run `do_experiment` for every factor on a process pool.  Each
+    factor's tasks are split into shards of `shard_size` tasks, and shard
+    `j` of factor `i` is seeded with `[seed, i, j]`, so the results depend
+    only on `seed` and `shard_size`, not on the number of `processes`.
+    Returns an `OrderedDict` mapping each factor to an
+    `ExperimentSummary`.
+    """
+    shards = []
+    for i, factor in enumerate(factors):
+        for j, start in enumerate(xrange(0, ntasks, shard_size)):
+            kwargs = dict(PlayerClass=PlayerClass, narms=narms,
+                    nplays=nplays, variance=variance, factor=factor,
+                    ntasks=min(shard_size, ntasks - start), block=block)
+            shards.append((factor, (kwargs, [seed, i, j])))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        summaries = pool.map(do_shard, [shard for (f, shard) in shards])
+    finally:
+        pool.close()
+        pool.join()
+
+    results = collections.OrderedDict()
+    for (factor, shard), summary in zip(shards, summaries):
+        if factor in results:
+            results[factor].merge(summary)
+        else:
+            results[factor] = summary
+    return results
+
+
 def experiment_2_1(PlayerClass=EpsilonPlayer, ntasks=2000, nplays=1000,
-        variance=1, factors=(0, 0.01, 0.1, 0.5)):
+        variance=1, factors=(0, 0.01, 0.1, 0.5), parallel=False, seed=0,
+        shard_size=100, processes=None, streaming=False, block=None,
+        directory=None):
+    """
+    Run one experiment per factor.  With `parallel`, `streaming` or
+    `directory`, each factor maps to an `ExperimentSummary` instead of a
+    list of players; `parallel` runs the sweep with `parallel_sweep`.
+    With `directory`, each factor is a `BanditRun` stored in its own
+    subdirectory, which is extended to `ntasks` and `nplays` rather than
+    rerun, and the results are mapped from its files.
+    """
+    if directory is not None:
+        results = collections.OrderedDict()
+        for f in factors:
+            run = BanditRun(os.path.join(directory, 'factor_{0}'.format(f)),
+                    PlayerClass, factor=f, variance=variance, seed=seed)
+            results[f] = run.extend(ntasks, nplays).summary()
+        return results
+    if parallel:
+        return parallel_sweep(PlayerClass, ntasks=ntasks, narms=10,
+                nplays=nplays, variance=variance, factors=factors, seed=seed,
+                shard_size=shard_size, processes=processes, block=block)
     experiment = functools.partial(do_experiment, PlayerClass=PlayerClass,
-            ntasks=ntasks, narms=10, nplays=nplays, variance=variance)
+            ntasks=ntasks, narms=10, nplays=nplays, variance=variance,
+            streaming=streaming, block=block)
     results = collections.OrderedDict([(f, experiment(factor=f)) for f in factors])
     return results
 
+def score(summary, criterion='average'):
+    """
+    Score a run by its mean reward averaged over all plays ('average') or
+    over the last tenth of the plays ('final').
+    """
+    rewards = mean_reward(summary)
+    if criterion == 'final':
+        rewards = rewards[-max(1, len(rewards) // 10):]
+    else:
+        assert(criterion == 'average')
+    return rewards.mean()
+
+
+def successive_halving(PlayerClass=EpsilonGreedyPolicy,
+        factors=np.linspace(0, 0.5, 26), ntasks=50, nplays=250, keep=0.5,
+        growth=None, play_growth=1, criterion='average', variance=1,
+        directory=None, seed=0):
+    """
+    Search `factors` for the best factor for `PlayerClass`.  Every
+    surviving factor is run for `ntasks` tasks of `nplays` plays, and
+    only the best `keep` fraction, by `score`, survive to the next round,
+    which runs `growth` times as many tasks of `play_growth` times as
+    many plays.  `growth` defaults to 1/keep, so that every round costs
+    about the same.  Stops as soon as one factor is left.
+
+    Each factor is a `BanditRun` in its own subdirectory of `directory`,
+    or of a temporary directory that is removed afterwards, seeded with
+    `seed`.  A survivor is grown with `BanditRun.extend`, so its tasks
+    and plays from earlier rounds are kept rather than run again.
+    Returns the best factor and the history, a list of one `OrderedDict`
+    of factor scores per round.
+    """
+    if growth is None:
+        growth = 1 / keep
+    survivors = list(factors)
+    history = []
+    if len(survivors) < 2:
+        return (survivors[0], history)
+    if directory is None:
+        import tempfile
+        scratch = tempfile.mkdtemp()
+        try:
+            return successive_halving(PlayerClass, factors, ntasks, nplays,
+                    keep, growth, play_growth, criterion, variance, scratch,
+                    seed)
+        finally:
+            shutil.rmtree(scratch)
+    runs = dict((f, BanditRun(os.path.join(directory, 'factor_{0}'.format(f)),
+        PlayerClass, factor=f, variance=variance, seed=seed))
+        for f in survivors)
+    while len(survivors) > 1:
+        scores = collections.OrderedDict((f, score(runs[f].extend(ntasks,
+            nplays).summary(), criterion)) for f in survivors)
+        history.append(scores)
+        ranked = sorted(survivors, key=scores.get, reverse=True)
+        survivors = ranked[:min(len(ranked) - 1,
+            max(1, int(np.ceil(keep * len(ranked)))))]
+        ntasks = int(round(ntasks * growth))
+        nplays = int(round(nplays * play_growth))
+    return (survivors[0], history)
+
+
 def plot_2_1(results):
     fig, (ax1, ax2) = pyplot.subplots(2,1, sharex=True, sharey=False)
     fig.hold(True)
     for factor in results:
-        factor_name = results[factor][0].factor_name
+        name = factor_name(results[factor])
         ax1.plot(mean_reward(results[factor]), 
-                label=r'${0}={1}$'.format(factor_name, factor))
+                label=r'${0}={1}$'.format(name, factor))
         ax2.plot(percent_optimal_action(results[factor]),
-                label=r'${0}={1}$'.format(factor_name, factor))
+                label=r'${0}={1}$'.format(name, factor))
 
     ax1.set_yticks(np.arange(0, 1.6, 0.5))
     ax1.set_ylabel('Average reward')
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+
+"""
+Utilities shared by the reinforcement learning experiments.  The
+experiments import this module from the parent directory with
+
+    sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                                 path.pardir))
+
+:author: Robert David Grant <robert.david.grant@gmail.com>
+
+:copyright: Copyright 2011 Robert Grant
+
+    Licensed under the Apache License, Version 2.0 (the "License"); you
+    may not use this file except in compliance with the License.  You
+    may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+    implied.  See the License for the specific language governing
+    permissions and limitations under the License.
+"""
+
+from __future__ import division, print_function
+
+import numpy as np
+
+
+def multimax(values, axis=None):
+    """
+    Return the tuple (maxvalue, maxindex).  If there is more than one max
+    value, return one of them randomly.
+
+    With `axis`, take the max along that axis of an N-D array instead, and
+    return arrays of the max values and of their indices along `axis`,
+    shaped like `np.argmax`'s result.  Ties are broken randomly and
+    independently for every position, in a single vectorized pass.
+    """
+    values = np.asarray(values)
+    if axis is None:
+        values = values.ravel()
+        axis = 0
+    maxvalues = values.max(axis)
+    ties = values == np.expand_dims(maxvalues, axis)
+    keys = np.where(ties, np.random.uniform(size=values.shape), -1)
+    return (maxvalues, keys.argmax(axis))
+
+
+## Tests
+
+def test_multimax():
+    assert(multimax([1, 2, 3, 4, 5, 6]) == (6, 5))
+    assert(multimax([[1, 2], [7, 3]]) == (7, 2))
+
+    values = np.array([[[1, 6, 6], [2, 2, 0]],
+                       [[5, 4, 3], [0, 0, 0]]])
+    maxvalues, maxindices = multimax(values, axis=-1)
+    assert((maxvalues == [[6, 2], [5, 0]]).all())
+    seen = set()
+    for x in range(200):
+        maxvalues, maxindices = multimax(values, axis=-1)
+        assert(maxindices[0, 0] in (1, 2) and maxindices[0, 1] in (0, 1))
+        assert(maxindices[1, 0] == 0)
+        seen.add(tuple(maxindices.ravel()))
+    assert(len(seen) == 2 * 2 * 3)
+
+    maxvalues, maxindices = multimax(values, axis=0)
+    assert((maxvalues == [[5, 6, 6], [2, 2, 0]]).all())
+    assert((maxindices[0] == [1, 0, 0]).all())
@@ -26,27 +26,29 @@ Sutton and Barto
 from __future__ import division, print_function
 import numpy as np
 import itertools
+import collections
+import bisect
+import multiprocessing
+import Queue
+import sys
+import os
+from os import path
 import matplotlib
 matplotlib.use('PDF')
 from matplotlib import pyplot
 
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             path.pardir))
+from rlutils import multimax
+
 
 class Const:
     ACE = 1
     HIT, STICK = (0, 1)
     USABLE_ACE, CURRENT_SUM, DEALER_SHOWING, ACTIONS = (0, 1, 2, 3)
     STATE_RANGES = [(0, 2), (12, 22), (1, 11), (0, 2)]
-
-
-def multimax(lst):
-    """
-    Return the tuple (maxvalue, maxindex).  If there is more than one max
-    value, return one of them randomly.
-    """
-    maxvalue = np.max(lst)
-    maxindices = np.flatnonzero(lst == maxvalue)
-    random_index = np.random.randint(len(maxindices))
-    return (maxvalue, maxindices[random_index])
+    #              A  2  3  4  5  6  7  8  9  10
+    CARD_WEIGHTS = [4, 4, 4, 4, 4, 4, 4, 4, 4, 16]
 
 
 def random_weighted(weights):
@@ -64,9 +66,15 @@ def random_card():
     Return value a random card, with each card weighted to it's proper
     probability of occurring
     """
-    #               A  2  3  4  5  6  7  8  9  10
-    card_weights = [4, 4, 4, 4, 4, 4, 4, 4, 4, 16]
-    return random_weighted(card_weights) + 1
+    return random_weighted(Const.CARD_WEIGHTS) + 1
+
+
+def random_cards(n):
+    """
+    Return an array of `n` random cards, weighted like `random_card`
+    """
+    cdf = np.cumsum(Const.CARD_WEIGHTS) / np.sum(Const.CARD_WEIGHTS)
+    return cdf.searchsorted(np.random.uniform(size=n)) + 1
 
 
 def test_random_card():
@@ -77,29 +85,272 @@ def test_random_card():
         assert(cards.tolist().count(10) > cards.tolist().count(x))
 
 
+class CardSource(object):
+    """
+    Stream of random cards, weighted like `random_card`, that are drawn
+    `block_size` at a time into a buffer and handed out one by one with
+    `next` or many at a time with `draw`.  The stream has its own
+    `np.random.RandomState`, seeded with `seed`, so it neither uses nor
+    disturbs the global numpy generator.
+    """
+
+    def __init__(self, seed=None, block_size=4096):
+        self.random_state = np.random.RandomState(seed)
+        self.block_size = block_size
+        self.cdf = np.cumsum(Const.CARD_WEIGHTS) / np.sum(Const.CARD_WEIGHTS)
+        self.buffer = []
+        self.position = 0
+
+    def __iter__(self):
+        return self
+
+    def sample(self, n):
+        """
+        Return an array of `n` new cards straight from the generator
+        """
+        return self.cdf.searchsorted(self.random_state.uniform(size=n)) + 1
+
+    def refill(self):
+        """
+        Replace the used-up buffer with a new block of cards
+        """
+        self.buffer = self.sample(self.block_size).tolist()
+        self.position = 0
+
+    def new_hand(self):
+        """
+        Called before each hand is dealt; the infinite deck needs nothing
+        """
+        pass
+
+    def next(self):
+        """
+        Return the next card
+        """
+        if self.position == len(self.buffer):
+            self.refill()
+        card = self.buffer[self.position]
+        self.position += 1
+        return card
+
+    def draw(self, n):
+        """
+        Return an array of the next `n` cards
+        """
+        cards = self.buffer[self.position:self.position + n]
+        self.position += len(cards)
+        while len(cards) < n:
+            self.refill()
+            more = self.buffer[:n - len(cards)]
+            self.position = len(more)
+            cards += more
+        return np.array(cards, int)
+
+    def get_state(self):
+        """
+        Return the state of the stream: the generator's state and the
+        cards still waiting in the buffer
+        """
+        return (self.random_state.get_state(), self.buffer[self.position:])
+
+    def set_state(self, state):
+        """
+        Restore a state returned by `get_state`
+        """
+        random_state, buffer = state
+        self.random_state.set_state(random_state)
+        self.buffer = list(buffer)
+        self.position = 0
+
+
+class Shoe(CardSource):
+    """
+    A shoe of `ndecks` decks, dealt without replacement.  `counts` is the
+    number of cards of each value, ace to ten, in the full shoe.  Each
+    shuffle lays the cards it counts out in a random order, which is then
+    dealt through the same buffer as `CardSource`, so a draw costs no
+    more than from the infinite deck.  The shoe is reshuffled before a
+    hand once a `penetration` fraction of it has been dealt, and
+    mid-hand if it runs out.
+
+    `running_count` is the Hi-Lo count of the cards dealt since the
+    shuffle.
+    """
+
+    #                     A  2  3  4  5  6  7  8  9  10
+    HI_LO = np.array([0, -1, 1, 1, 1, 1, 1, 0, 0, 0, -1])
+
+    def __init__(self, ndecks=6, penetration=0.75, seed=None):
+        CardSource.__init__(self, seed)
+        self.ndecks = ndecks
+        self.counts = np.array(Const.CARD_WEIGHTS) * ndecks
+        self.size = self.counts.sum()
+        self.penetration = penetration
+        self.refill()
+
+    def refill(self):
+        """
+        Shuffle the full shoe
+        """
+        self.set_order(self.random_state.permutation(
+            np.repeat(np.arange(1, 11), self.counts)))
+
+    def set_order(self, cards):
+        """
+        Deal the array `cards` next, as the end of a shoe
+        """
+        cards = np.asarray(cards, int)
+        self.position = self.size - len(cards)
+        self.buffer = [0] * self.position + cards.tolist()
+        # the count is balanced, so the cards dealt count the negative of
+        # the cards left
+        self.running_counts = np.concatenate(([0],
+            np.cumsum(self.HI_LO[self.buffer]))) - self.HI_LO[cards].sum()
+
+    def new_hand(self):
+        if self.position >= self.penetration * self.size:
+            self.refill()
+
+    def running_count(self):
+        return self.running_counts[self.position]
+
+    def remaining(self):
+        """
+        Return the count vector of the cards left in the shoe
+        """
+        return np.bincount(self.buffer[self.position:], minlength=11)[1:]
+
+    def set_state(self, state):
+        random_state, buffer = state
+        self.random_state.set_state(random_state)
+        self.set_order(buffer)
+
+
+def default_cards():
+    """
+    Return a new `CardSource` seeded from the global numpy generator, so
+    that `np.random.seed` still makes a whole run reproducible
+    """
+    return CardSource(np.random.randint(2**32))
+
+
+def test_CardSource():
+    cards = CardSource(seed=1, block_size=100)
+    drawn = np.array([cards.next() for x in xrange(250)] +
+            cards.draw(3000).tolist())
+    assert(((1 <= drawn) & (drawn <= 10)).all())
+    frequencies = np.bincount(drawn, minlength=11)[1:] / len(drawn)
+    assert(np.allclose(frequencies, np.array(Const.CARD_WEIGHTS) /
+        np.sum(Const.CARD_WEIGHTS), atol=0.02))
+
+    # the same seed gives the same stream, however it is read
+    other = CardSource(seed=1, block_size=100)
+    assert((other.draw(3250) == drawn).all())
+
+    # and a saved state replays the rest of it
+    state = cards.get_state()
+    rest = [cards.next() for x in xrange(500)]
+    other = CardSource()
+    other.set_state(state)
+    assert(other.draw(500).tolist() == rest)
+
+    # players with the default cards follow np.random.seed
+    Qs = []
+    global_state = np.random.get_state()
+    try:
+        for x in xrange(2):
+            np.random.seed(0)
+            p = Player('rnd_pairs')
+            p.run_episodes(2000)
+            Qs.append(p.Q)
+    finally: # don't leave the later statistical tests a fixed stream
+        np.random.set_state(global_state)
+    assert((Qs[0] == Qs[1]).all())
+
+
+def test_Shoe():
+    shoe = Shoe(ndecks=2, penetration=0.5, seed=2)
+    assert(shoe.size == 104 and shoe.running_count() == 0)
+    dealt = [shoe.next() for x in xrange(60)]
+    assert((shoe.remaining() == shoe.counts - np.bincount(dealt,
+        minlength=11)[1:]).all())
+    assert(shoe.running_count() == shoe.HI_LO[dealt].sum())
+    state = shoe.get_state()
+
+    # a whole shoe is dealt without replacement, mid-hand if need be
+    rest = shoe.draw(44 + 104)
+    assert((np.bincount(dealt + rest[:44].tolist(), minlength=11)[1:] ==
+        shoe.counts).all())
+    assert((np.bincount(rest[44:], minlength=11)[1:] == shoe.counts).all())
+
+    # and reshuffled between hands past the penetration
+    other = Shoe(ndecks=2, penetration=0.5)
+    other.set_state(state)
+    assert(other.running_count() == shoe.HI_LO[dealt].sum())
+    assert(other.draw(44).tolist() == rest[:44].tolist())
+    other.set_state(state)
+    other.new_hand()
+    assert(other.position == 0 and other.running_count() == 0)
+    assert(other.draw(104).tolist() == rest[44:].tolist())
+
+    # as is a shoe that batches of episodes are dealt from
+    other.set_state(state)
+    stick = np.array([[0, 20, 5, Const.STICK]])
+    simulate_episodes(Player('rnd_pairs').policy, stick, True, other)
+    assert(other.position == 0 and other.running_count() == 0)
+
+    d = Dealer(Shoe(ndecks=1))
+    for x in xrange(100):
+        d.new_game(np.random.randint(1, 11))
+        d.play_game()
+        assert(17 <= d.current_sum <= 26)
+
+    # a counting player learns separately in each count bucket
+    p = Player('all_pairs', cards=Shoe(ndecks=1), count_buckets=[-1, 1])
+    p.run_episodes(5000)
+    assert(p.bucket_Q_count.sum(0).sum() >= 5000)
+    assert((p.bucket_Q_count.reshape(3, -1).sum(1) > 0).all())
+    assert(p.Q.base is p.bucket_Q)
+
+
 def ind(tup):
     return tuple([i] for i in tup)
 
 
+def add_dealer_card(current_sum, naces, card):
+    """
+    Return the dealer's (current_sum, naces) after taking `card`.  Aces
+    count 11 until the sum would bust, then 1.
+    """
+    if card == Const.ACE:
+        naces += 1
+        card = 11
+    current_sum += card
+    if current_sum > 21 and naces > 0:
+        current_sum -= 10
+        naces -= 1
+    return (current_sum, naces)
+
+
 class Dealer:
     """
-    Blackjack dealer
+    Blackjack dealer, drawing from the `CardSource` `cards`, or from
+    `default_cards()`
     """
-    def __init__(self):
+    def __init__(self, cards=None):
+        self.cards = cards or default_cards()
         self.showing_card = None
         self.current_sum = None
         self.naces = 0
 
     def update_current_sum(self, card):
-        if card == Const.ACE:
-            self.naces += 1
-        self.current_sum += card
-        if is_busted(self) and self.naces > 0:
-            self.current_sum -= 10
-            self.naces -= 1
+        self.current_sum, self.naces = add_dealer_card(self.current_sum,
+                self.naces, card)
 
     def new_game(self, showing_card):
+        self.cards.new_hand()
         self.current_sum = 0
+        self.naces = 0
         self.showing_card = showing_card
         self.update_current_sum(showing_card)
 
@@ -109,7 +360,7 @@ class Dealer:
         11 unless bust, then treat as 1
         """
         while self.current_sum < 17:
-            next_card = random_card()
+            next_card = self.cards.next()
             self.update_current_sum(next_card)
 
 def test_Dealer():
@@ -127,7 +378,8 @@ class Player:
     monte-carlo exploring-starts.
     """
 
-    def __init__(self, es_strategy):
+    def __init__(self, es_strategy, exact_dealer=False, cards=None,
+            count_buckets=None):
         """
         self.Q is the computed state-action values, a floating-point
         value from -1 to 1, represented as a 4-D array with dimensions
@@ -149,19 +401,45 @@ class Player:
 
         self.policy is a 3-D array, with dimensions equal to the first
         three dimensions of self.Q
+
+        With `exact_dealer`, the dealer's hand is not played out; each
+        episode is scored with its expected reward from
+        `EXPECTED_REWARDS` instead.
+
+        The player and its dealer draw from the `CardSource` `cards`, one
+        from `default_cards` by default, or from a `Shoe`.  The start state
+        itself is not dealt from the shoe.
+
+        With `count_buckets`, an increasing list of running counts, the
+        shoe's running count before each hand is also part of the state:
+        the player keeps one set of tables per bucket between the counts,
+        stacked in self.bucket_Q, self.bucket_Q_count and
+        self.bucket_policy, and self.Q, self.Q_count and self.policy are
+        the current hand's bucket of them.
         """
         self.Q = np.zeros([t[-1] for t in Const.STATE_RANGES])
         self.Q_count = np.zeros(self.Q.shape, int)
         self.policy = np.zeros(self.Q.shape[0:-1], int)
         self.policy[:, [20, 21], :] = Const.STICK # stick on 20 and 21 initially
-        self.dealer = Dealer()
+        self.cards = cards or default_cards()
+        self.dealer = Dealer(self.cards)
         self.current_sum = None
         self.states = None
         self.nepisodes = 0
+        self.telemetry = [] # Telemetry of each window of run_experiment
+        self.es_position = 0
+        self.es_strategy = es_strategy
+        self.exact_dealer = exact_dealer
+        self.count_buckets = count_buckets
+        if count_buckets is not None:
+            nbuckets = len(count_buckets) + 1
+            self.bucket_Q = np.zeros((nbuckets,) + self.Q.shape)
+            self.bucket_Q_count = np.zeros(self.bucket_Q.shape, int)
+            self.bucket_policy = np.array([self.policy] * nbuckets)
+            self.select_bucket(0)
 
         if es_strategy == 'all_pairs': # enumerate all start state-action pairs
-            self.next_state = itertools.cycle(itertools.product(*[xrange(*t)
-                for t in Const.STATE_RANGES]))
+            self.next_state = self.all_pairs()
         elif es_strategy == 'rnd_pairs': # start with a random start state-action pair
             self.next_state = self.random_pairs()
         elif es_strategy == 'rnd_states': # start with a random state only
@@ -169,6 +447,26 @@ class Player:
         else:
             assert(0)
 
+    def select_bucket(self, bucket):
+        """
+        Make the tables of count bucket `bucket` the current ones
+        """
+        self.bucket = bucket
+        self.Q = self.bucket_Q[bucket]
+        self.Q_count = self.bucket_Q_count[bucket]
+        self.policy = self.bucket_policy[bucket]
+
+    def all_pairs(self, start=0):
+        """
+        Cycle through every start state-action pair, beginning with the
+        `start`th.  `self.es_position` keeps the number of the next one.
+        """
+        pairs = list(itertools.product(*[xrange(*t) for t in
+            Const.STATE_RANGES]))
+        for n in itertools.count(start):
+            self.es_position = n + 1
+            yield pairs[n % len(pairs)]
+
     def random_pairs(self):
         while True:
             yield tuple(np.random.randint(*t) for t in Const.STATE_RANGES)
@@ -184,6 +482,11 @@ class Player:
         Play through a game of blackjack, starting in a random or
         enumerated state
         """
+        self.cards.new_hand()
+        if self.count_buckets is not None:
+            self.select_bucket(bisect.bisect_right(self.count_buckets,
+                self.cards.running_count()))
+
         # choose starting state-action pair
         next_pair = self.next_state.next()
         start_state = tuple(next_pair[:3])
@@ -197,7 +500,7 @@ class Player:
 
         while (not is_busted(self) and action == Const.HIT):
 #                self.policy[self.states[-1]] == Const.HIT): # first try
-            self.current_sum = self.states[-1][Const.CURRENT_SUM] + random_card()
+            self.current_sum = self.states[-1][Const.CURRENT_SUM] + self.cards.next()
             if not is_busted(self):
                 next_state = (self.states[-1][Const.USABLE_ACE],
                               self.current_sum,
@@ -220,26 +523,84 @@ class Player:
         """
         Incrementally update each visted state with reward from game outcome
         """
+        # a single episode visits only a few pairs, so scattering costs
+        # more than it saves; see update_Q_visits
         for state, action in zip(self.states, self.actions):
             Q_index = state + (action,)
             self.Q_count[Q_index] += 1
             self.Q[Q_index] += (1/self.Q_count[Q_index]) * (reward - self.Q[Q_index])
 
-    def update_policy(self):
+    def update_Q_batch(self, episodes):
+        """
+        Incrementally update each state-action pair visited in a batch
+        of `Episodes` with the reward of its episode
+        """
+        self.update_Q_visits(episodes.states, episodes.actions,
+                episodes.rewards[episodes.episode])
+
+    def update_Q_visits(self, states, actions, rewards):
+        """
+        Update Q and Q_count with one reward per visit to a state-action
+        pair, all at once, with `update_averages`
+        """
+        update_averages(self.Q, self.Q_count, states, actions, rewards)
+
+    def update_policy(self, states=None):
         """
         Set the new policy to be the action leading to the highest value
-        from every visited state
+        from every visited state, or from every one of `states`
+        """
+        if states is None: # one episode never visits a state twice
+            state_index = np.ravel_multi_index(tuple(np.transpose(
+                self.states)), self.policy.shape)
+        else:
+            state_index = np.unique(np.ravel_multi_index(
+                tuple(np.transpose(states)), self.policy.shape))
+        Q = self.Q.reshape(-1, self.Q.shape[-1])
+        self.policy.reshape(-1)[state_index] = multimax(Q[state_index],
+                axis=-1)[1]
+
+    def run_batch(self, nepisodes):
+        """
+        Generate `nepisodes` monte carlo episodes at once with
+        `simulate_episodes`.  All of them follow the policy as it was at
+        the start of the batch.  Counting players need one episode at a
+        time.
+        """
+        if self.count_buckets is not None:
+            raise ValueError("count buckets need run_episode, not run_batch")
+        starts = np.array([self.next_state.next() for n in
+            xrange(nepisodes)])
+        episodes = simulate_episodes(self.policy, starts, self.exact_dealer,
+                self.cards)
+        self.update_Q_batch(episodes)
+        self.update_policy(episodes.states)
+        self.nepisodes += nepisodes
+
+    def run_episodes(self, nepisodes, batch_size=None):
+        """
+        Generate `nepisodes` monte carlo episodes, `batch_size` at a time
+        if given.
         """
-        for state in self.states:
-            self.policy[state] = multimax(self.Q[state])[1]
+        if batch_size:
+            for start in xrange(0, nepisodes, batch_size):
+                self.run_batch(min(batch_size, nepisodes - start))
+        else:
+            for n in xrange(nepisodes):
+                self.run_episode()
 
     def run_episode(self):
         """
         Generate a monte carlo episode.
         """
         self.play_game()
-        self.dealer.play_game()
-        self.update_Q(compute_reward(self, self.dealer))
+        if self.exact_dealer:
+            reward = EXPECTED_REWARDS[self.current_sum,
+                    self.dealer.showing_card]
+        else:
+            self.dealer.play_game()
+            reward = compute_reward(self, self.dealer)
+        self.update_Q(reward)
         self.update_policy()
 
     def counts(self, usable, action):
@@ -252,6 +613,182 @@ class Player:
                 dealer_showing_range[0]:, action]
 
 
+def update_averages(Q, Q_weight, states, actions, rewards, weights=None):
+    """
+    Fold one reward per visit to a state-action pair into the averages Q,
+    whose entries so far weigh `Q_weight`, all at once: the visits are
+    scatter-added by flat index into the raveled tables, and each touched
+    Q entry moves to the weighted average of its old returns and its new
+    ones, exactly as updating visit by visit would.  Visits weigh one
+    each, or `weights`.
+    """
+    Q_index = np.ravel_multi_index(tuple(np.transpose(states)) +
+            (np.asarray(actions),), Q.shape)
+    Q_index, visit = np.unique(Q_index, return_inverse=True)
+    visit_weights = np.bincount(visit, weights=weights)
+    if weights is None:
+        visit_weights = visit_weights.astype(Q_weight.dtype)
+    reward_sums = np.bincount(visit, weights=rewards if weights is None
+            else weights * rewards)
+    Q = Q.reshape(-1)
+    Q_weight = Q_weight.reshape(-1)
+    Q_weight[Q_index] += visit_weights
+    Q[Q_index] += (reward_sums - visit_weights * Q[Q_index]) / Q_weight[Q_index]
+
+
+class Episodes(collections.namedtuple('Episodes',
+        'episode step states actions rewards')):
+    """
+    A batch of episodes, as one row per state-action pair visited: the
+    index of its `episode`, its `step` within the episode, its
+    (usable_ace, current_sum, dealer_showing) `states` row and its
+    `actions` entry.  `rewards` has one entry per episode.
+    """
+    __slots__ = ()
+
+
+def play_dealers(showing, cards=None):
+    """
+    Play out one dealer hand per card in the array `showing`, all at
+    once, with the same strategy and ace handling as `Dealer`.  Return
+    the array of the dealers' final sums.  Cards come from the
+    `CardSource` `cards` if given, and from `random_cards` otherwise.
+    """
+    draw = cards.draw if cards else random_cards
+    naces = (np.asarray(showing) == Const.ACE).astype(int)
+    current_sum = np.where(naces, 11, showing)
+    active = np.flatnonzero(current_sum < 17)
+    while active.size:
+        card = draw(active.size)
+        naces[active] += card == Const.ACE
+        new_sum = current_sum[active] + np.where(card == Const.ACE, 11, card)
+        soften = (new_sum > 21) & (naces[active] > 0)
+        new_sum[soften] -= 10
+        naces[active[soften]] -= 1
+        current_sum[active] = new_sum
+        active = active[new_sum < 17]
+    return current_sum
+
+
+def simulate_episodes(policy, starts, exact_dealer=False, cards=None):
+    """
+    Play one game of blackjack per row of `starts`, a (nepisodes, 4)
+    array of start state-action pairs, all at once.  The player follows
+    `policy` after the first action, or if `policy` is an array of
+    floats, hits with the probability it gives for each state (see
+    `soft_policy`).  The dealer plays as in
+    `play_dealers`; every game is played exactly as
+    `Player.play_game` and `Dealer.play_game` would play it.  With
+    `exact_dealer`, games are scored with `EXPECTED_REWARDS` instead of
+    playing the dealers.  Cards are drawn as in `play_dealers`; a shoe
+    in `cards` gets one `new_hand` per batch, so it is reshuffled before
+    the batch once it is past its penetration.  Return the `Episodes`.
+    """
+    if cards:
+        cards.new_hand()
+    draw = cards.draw if cards else random_cards
+    stochastic = np.asarray(policy).dtype.kind == 'f'
+    nepisodes = len(starts)
+    usable = starts[:, Const.USABLE_ACE].copy()
+    current_sum = starts[:, Const.CURRENT_SUM].copy()
+    showing = starts[:, Const.DEALER_SHOWING]
+    episodes = [np.arange(nepisodes)]
+    states = [starts[:, :Const.ACTIONS]]
+    actions = [starts[:, Const.ACTIONS]]
+
+    active = np.flatnonzero(actions[0] == Const.HIT)
+    while active.size:
+        new_sum = current_sum[active] + draw(active.size)
+        busted = new_sum > 21
+        soft = busted & (usable[active] == 1) # busted, but usable ace
+        new_sum[soft] -= 10
+        usable[active[soft]] = 0
+        current_sum[active] = new_sum
+        active = active[~busted | soft]
+        state = np.column_stack((usable[active], current_sum[active],
+            showing[active]))
+        action = policy[tuple(state.T)]
+        if stochastic:
+            action = np.where(np.random.uniform(size=len(action)) < action,
+                    Const.HIT, Const.STICK)
+        episodes.append(active)
+        states.append(state)
+        actions.append(action)
+        active = active[action == Const.HIT]
+
+    if exact_dealer:
+        rewards = EXPECTED_REWARDS[current_sum, showing]
+    else:
+        dealer_sum = play_dealers(showing, cards)
+        player_busted = current_sum > 21
+        dealer_busted = dealer_sum > 21
+        rewards = np.sign(current_sum - dealer_sum)
+        rewards[dealer_busted] = 1
+        rewards[player_busted] = -1
+        rewards[player_busted & dealer_busted] = 0 # draw, as in compute_reward
+
+    steps = [np.zeros(len(e), int) + n for n, e in enumerate(episodes)]
+    return Episodes(np.concatenate(episodes), np.concatenate(steps),
+            np.concatenate(states), np.concatenate(actions), rewards)
+
+
+def test_simulate_episodes():
+    # the batched dealer plays like Dealer
+    showing = np.random.randint(1, 11, 20000)
+    batch_sums = play_dealers(showing)
+    d = Dealer()
+    scalar_sums = []
+    for card in showing:
+        d.new_game(card)
+        d.play_game()
+        scalar_sums.append(d.current_sum)
+    for total in xrange(17, 27):
+        assert(abs(np.mean(batch_sums == total) -
+                   np.mean(np.equal(scalar_sums, total))) < 0.015)
+
+    # and whole episodes play like Player.play_game
+    p = Player('rnd_pairs')
+    starts = np.array([p.next_state.next() for x in xrange(20000)])
+    episodes = simulate_episodes(p.policy, starts)
+    assert(episodes.rewards.shape == (20000,))
+    assert((episodes.states[episodes.step == 0] == starts[:, :3]).all())
+    assert((episodes.states[:, Const.CURRENT_SUM] <= 21).all())
+    scalar_rewards = []
+    for start in starts:
+        p.next_state = iter([start])
+        p.play_game()
+        p.dealer.play_game()
+        scalar_rewards.append(compute_reward(p, p.dealer))
+    assert(abs(episodes.rewards.mean() - np.mean(scalar_rewards)) < 0.03)
+
+    p = Player('all_pairs')
+    p.run_batch(1000)
+    assert(p.nepisodes == 1000)
+    assert(p.Q_count.sum() >= 1000)
+    assert(p.Q_count[:, 12:, 1:].all())
+
+
+def test_update_Q():
+    # scatter-adding a batch matches updating one visit at a time
+    p = Player('rnd_pairs')
+    p.run_batch(500)
+    Q, Q_count = p.Q.copy(), p.Q_count.copy()
+    starts = np.array([p.next_state.next() for x in xrange(2000)])
+    episodes = simulate_episodes(p.policy, starts)
+    p.update_Q_batch(episodes)
+    for visit in xrange(len(episodes.episode)):
+        Q_index = tuple(episodes.states[visit]) + (episodes.actions[visit],)
+        reward = episodes.rewards[episodes.episode[visit]]
+        Q_count[Q_index] += 1
+        Q[Q_index] += (1/Q_count[Q_index]) * (reward - Q[Q_index])
+    assert((p.Q_count == Q_count).all())
+    assert(np.allclose(p.Q, Q))
+
+    p.update_policy(episodes.states)
+    visited = tuple(episodes.states.T)
+    assert((p.Q[visited + (p.policy[visited],)] == p.Q[visited].max(-1)).all())
+
+
 def is_busted(player):
     if player.current_sum > 21:
         busted = True
@@ -308,6 +845,328 @@ def test_compute_reward():
         assert r == 0
 
 
+def dealer_probabilities():
+    """
+    Compute the exact probability of each final sum of `Dealer.play_game`
+    for each showing card, by dynamic programming over the dealer's
+    (current_sum, naces) states with the card weights of `random_card`,
+    stepping with `add_dealer_card`, so no cards are drawn.
+    Returns a 2-D array indexed by [showing_card, final_sum]; final sums
+    run from 17 to 26, and those over 21 are busts.
+    """
+    card_probabilities = np.array(Const.CARD_WEIGHTS) / np.sum(Const.CARD_WEIGHTS)
+    outcomes = {}
+
+    def final_sums(current_sum, naces):
+        if (current_sum, naces) not in outcomes:
+            probabilities = np.zeros(27)
+            if current_sum >= 17:
+                probabilities[current_sum] = 1
+            else:
+                for card, p in enumerate(card_probabilities, 1):
+                    probabilities += p * final_sums(*add_dealer_card(
+                        current_sum, naces, card))
+            outcomes[current_sum, naces] = probabilities
+        return outcomes[current_sum, naces]
+
+    table = np.zeros((11, 27))
+    for showing_card in xrange(*Const.STATE_RANGES[Const.DEALER_SHOWING]):
+        table[showing_card] = final_sums(*add_dealer_card(0, 0,
+            showing_card))
+    return table
+
+
+def expected_rewards(dealer_table):
+    """
+    Return the expected reward of finishing with each player sum against
+    each dealer showing card, as a 2-D array indexed by [player_sum,
+    showing_card].  Player sums run up to 31, and those over 21 are
+    busts.  Rewards are scored as in `compute_reward`.
+    """
+    player_sums = np.arange(32)[:, np.newaxis]
+    dealer_sums = np.arange(27)
+    rewards = np.sign(player_sums - dealer_sums)
+    rewards[:, dealer_sums > 21] = 1
+    rewards[player_sums[:, 0] > 21] = np.where(dealer_sums > 21, 0, -1)
+    return np.dot(rewards, dealer_table.T)
+
+
+DEALER_PROBABILITIES = dealer_probabilities()
+EXPECTED_REWARDS = expected_rewards(DEALER_PROBABILITIES)
+
+
+def test_dealer_probabilities():
+    assert(np.allclose(DEALER_PROBABILITIES[1:].sum(1), 1))
+    assert((DEALER_PROBABILITIES[:, :17] == 0).all())
+    # the table is computed at import, so it must leave np.random alone
+    before = np.random.get_state()
+    assert((dealer_probabilities() == DEALER_PROBABILITIES).all())
+    after = np.random.get_state()
+    assert((after[1] == before[1]).all() and after[2] == before[2])
+
+    showing = np.repeat(np.arange(1, 11), 5000)
+    final_sums = play_dealers(showing)
+    for showing_card in xrange(1, 11):
+        frequencies = np.bincount(final_sums[showing == showing_card],
+                minlength=27) / 5000
+        assert(np.allclose(frequencies, DEALER_PROBABILITIES[showing_card],
+            atol=0.025))
+
+    assert((EXPECTED_REWARDS[22:, 1:] < 0).all())
+    assert((np.diff(EXPECTED_REWARDS[17:22, 1:], axis=0) > 0).all())
+    p = Player('rnd_pairs', exact_dealer=True)
+    for x in xrange(100):
+        p.run_episode()
+    p.run_batch(100)
+    assert(p.nepisodes == 200)
+
+
+
+class Solution(collections.namedtuple('Solution', 'Q policy V')):
+    """
+    Optimal action values, policy and state values, shaped like
+    `Player.Q`, `Player.policy` and `Player.policy`
+    """
+    __slots__ = ()
+
+
+def solve_blackjack(filename=None, tolerance=1e-12):
+    """
+    Compute the optimal `Solution` by value iteration on the exact model:
+    the player draws with the card weights of `random_card`, and sticking
+    is scored with `EXPECTED_REWARDS`.  Hitting never lowers the player's
+    sum without spending the usable ace, so this converges in a handful
+    of sweeps.  Ties go to hitting.  With `filename`, the arrays are also
+    saved there with `np.savez`.
+    """
+    card_probabilities = np.array(Const.CARD_WEIGHTS) / np.sum(Const.CARD_WEIGHTS)
+    sums = np.arange(*Const.STATE_RANGES[Const.CURRENT_SUM])[:, np.newaxis]
+    showing = np.arange(*Const.STATE_RANGES[Const.DEALER_SHOWING])
+    states = np.s_[:, sums[0, 0]:, showing[0]:]
+
+    Q = np.zeros([t[-1] for t in Const.STATE_RANGES])
+    Q[states + (Const.STICK,)] = EXPECTED_REWARDS[sums, showing]
+    while True:
+        V = Q.max(-1)
+        hit = np.zeros(V.shape)
+        for card, p in enumerate(card_probabilities, 1):
+            new_sum = np.minimum(sums + card, 31)
+            busted = new_sum > 21
+            stay = np.where(busted, 21, new_sum)
+            hit[states][0] += p * np.where(busted,
+                    EXPECTED_REWARDS[new_sum, showing], V[0, stay, showing])
+            hit[states][1] += p * np.where(busted,
+                    V[0, np.where(busted, new_sum - 10, 21), showing],
+                    V[1, stay, showing])
+        change = np.abs(hit - Q[..., Const.HIT]).max()
+        Q[..., Const.HIT] = hit
+        if change <= tolerance:
+            break
+
+    solution = Solution(Q, Q.argmax(-1), Q.max(-1))
+    if filename is not None:
+        np.savez(filename, **solution._asdict())
+    return solution
+
+
+def state_values(array):
+    """
+    The part of a `Player.Q`- or `Player.policy`-shaped array that holds
+    real states
+    """
+    return array[:, Const.STATE_RANGES[Const.CURRENT_SUM][0]:,
+            Const.STATE_RANGES[Const.DEALER_SHOWING][0]:]
+
+
+def bucket_tables(player, name):
+    """
+    Return the list of `player`'s table `name` ('Q', 'Q_count' or
+    'policy') in each count bucket, or just the table itself for a player
+    that doesn't count
+    """
+    if getattr(player, 'count_buckets', None) is None:
+        return [getattr(player, name)]
+    return list(getattr(player, 'bucket_' + name))
+
+
+def policy_error(player, solution):
+    """
+    Fraction of states where `player`'s policy differs from the optimal
+    policy of `solution`, over all count buckets
+    """
+    return np.mean([state_values(policy) != state_values(solution.policy)
+        for policy in bucket_tables(player, 'policy')])
+
+
+def Q_error(player, solution):
+    """
+    Root-mean-square difference between `player`'s Q and the optimal Q
+    of `solution`, over all state-action pairs of all count buckets
+    """
+    return np.sqrt(np.mean([(state_values(Q) - state_values(solution.Q))**2
+        for Q in bucket_tables(player, 'Q')]))
+
+
+def test_solve_blackjack():
+    Q, policy, V = solve_blackjack()
+    assert((state_values(V) <= 1).all() and (state_values(V) >= -1).all())
+    assert((Q[:, 12:, 1:, Const.STICK] == EXPECTED_REWARDS[12:22, 1:]).all())
+
+    # never hit 20 or 21, and always hit a soft 12
+    assert((state_values(policy)[:, 8:] == Const.STICK).all())
+    assert((state_values(policy)[1, 0] == Const.HIT).all())
+
+    # playing the optimal policy earns V on average
+    starts = np.array(list(itertools.product(
+        *[xrange(*t) for t in Const.STATE_RANGES[:-1]])) * 200)
+    starts = np.column_stack((starts, policy[tuple(starts.T)]))
+    episodes = simulate_episodes(policy, starts, exact_dealer=True)
+    assert(abs(episodes.rewards.mean() - state_values(V).mean()) < 0.01)
+
+    p = Player('rnd_pairs')
+    p.Q = Q.copy()
+    p.policy = policy.copy()
+    assert(policy_error(p, Solution(Q, policy, V)) == 0)
+    assert(Q_error(p, Solution(Q, policy, V)) == 0)
+
+
+def soft_policy(policy, epsilon):
+    """
+    Return the probability of hitting in each state for the policy that
+    follows `policy` but picks a random action with probability
+    `epsilon`, as an array of floats for `simulate_episodes`
+    """
+    return np.where(policy == Const.HIT, 1 - epsilon / 2, epsilon / 2)
+
+
+def behavior_starts(behavior, nepisodes):
+    """
+    Return a (nepisodes, 4) array of random start states, each with a
+    first action chosen by the stochastic policy `behavior`
+    """
+    states = np.column_stack([np.random.randint(*t, size=nepisodes) for t in
+        Const.STATE_RANGES[:-1]])
+    hits = np.random.uniform(size=nepisodes) < behavior[tuple(states.T)]
+    return np.column_stack((states, np.where(hits, Const.HIT, Const.STICK)))
+
+
+class OffPolicyLearner(object):
+    """
+    Off-policy monte carlo with weighted importance sampling.  Learns the
+    action values Q of a target policy from episodes played by any
+    stochastic behavior policy that tries every action the target takes.
+    Each return is weighted by how much more likely the target policy was
+    than the behavior policy to take the actions that followed the visit,
+    and Q is the weighted average of the returns.
+
+    Without `target`, the target policy is greedy with respect to Q and
+    is updated after each batch, as in off-policy monte carlo control.
+    With `target`, a `Player.policy`-shaped array, that policy is only
+    evaluated.  Several learners can share the same batches of episodes.
+    """
+
+    def __init__(self, target=None):
+        self.Q = np.zeros([t[-1] for t in Const.STATE_RANGES])
+        self.Q_weight = np.zeros(self.Q.shape)
+        if target is None:
+            self.greedy = True
+            self.policy = np.zeros(self.Q.shape[0:-1], int)
+            self.policy[:, [20, 21], :] = Const.STICK
+        else:
+            self.greedy = False
+            self.policy = np.array(target)
+        self.nepisodes = 0
+
+    def visit_weights(self, episodes, behavior):
+        """
+        Return the importance-sampling weight of each visit in
+        `episodes`, played by the stochastic policy `behavior`: the
+        product, over the rest of its episode, of the ratios of the
+        target's and the behavior's probabilities of each action taken
+        """
+        states = tuple(episodes.states.T)
+        p_behavior = np.where(episodes.actions == Const.HIT,
+                behavior[states], 1 - behavior[states])
+        ratios = (episodes.actions == self.policy[states]) / p_behavior
+        weights = np.empty(len(ratios))
+        episode_weights = np.ones(len(episodes.rewards))
+        for step in xrange(episodes.step.max(), -1, -1):
+            visits = np.flatnonzero(episodes.step == step)
+            weights[visits] = episode_weights[episodes.episode[visits]]
+            episode_weights[episodes.episode[visits]] *= ratios[visits]
+        return weights
+
+    def update(self, episodes, behavior):
+        """
+        Learn from a batch of `Episodes` played by `behavior`
+        """
+        weights = self.visit_weights(episodes, behavior)
+        visits = weights > 0
+        update_averages(self.Q, self.Q_weight, episodes.states[visits],
+                episodes.actions[visits],
+                episodes.rewards[episodes.episode[visits]], weights[visits])
+        if self.greedy and visits.any():
+            states = np.unique(np.ravel_multi_index(
+                tuple(episodes.states[visits].T), self.policy.shape))
+            Q = self.Q.reshape(-1, self.Q.shape[-1])
+            self.policy.reshape(-1)[states] = multimax(Q[states], axis=-1)[1]
+        self.nepisodes += len(episodes.rewards)
+
+
+def run_off_policy(learners, behavior, nepisodes, batch_size=10000,
+        exact_dealer=False, cards=None):
+    """
+    Play `nepisodes` episodes with the stochastic policy `behavior`,
+    `batch_size` at a time, and let each of `learners` learn from every
+    batch.  The other arguments are as for `simulate_episodes`.
+    """
+    for start in xrange(0, nepisodes, batch_size):
+        starts = behavior_starts(behavior, min(batch_size, nepisodes - start))
+        episodes = simulate_episodes(behavior, starts, exact_dealer, cards)
+        for learner in learners:
+            learner.update(episodes, behavior)
+
+
+def test_off_policy():
+    np.random.seed(5)
+    solution = solve_blackjack()
+    behavior = soft_policy(solution.policy, 0.5)
+    stochastic = simulate_episodes(behavior, behavior_starts(behavior, 20000),
+            exact_dealer=True)
+    followed = (stochastic.actions == solution.policy[tuple(stochastic.states.T)])
+    assert(abs(followed[stochastic.step > 0].mean() - 0.75) < 0.02)
+
+    # weighted returns match the visit-by-visit algorithm
+    learner = OffPolicyLearner(solution.policy)
+    episodes = simulate_episodes(behavior, behavior_starts(behavior, 2000))
+    learner.update(episodes, behavior)
+    Q, Q_weight = np.zeros(learner.Q.shape), np.zeros(learner.Q.shape)
+    for e in xrange(2000):
+        W = 1
+        for visit in np.flatnonzero(episodes.episode == e)[::-1]:
+            state = tuple(episodes.states[visit])
+            action = episodes.actions[visit]
+            Q_weight[state + (action,)] += W
+            Q[state + (action,)] += (W / Q_weight[state + (action,)] *
+                    (episodes.rewards[e] - Q[state + (action,)]))
+            if action != solution.policy[state]:
+                break
+            W /= behavior[state] if action == Const.HIT else 1 - behavior[state]
+    assert(np.allclose(learner.Q_weight, Q_weight))
+    assert(np.allclose(learner.Q, Q))
+
+    # one stream of episodes evaluates a fixed policy and finds the best
+    evaluator = OffPolicyLearner(solution.policy)
+    controller = OffPolicyLearner()
+    run_off_policy([evaluator, controller], soft_policy(np.zeros_like(
+        solution.policy), 1), 200000, exact_dealer=True)
+    assert(evaluator.nepisodes == controller.nepisodes == 200000)
+    V = np.where(solution.policy == Const.HIT, evaluator.Q[..., Const.HIT],
+            evaluator.Q[..., Const.STICK])
+    assert(abs(state_values(V - solution.V)).mean() < 0.03)
+    assert(policy_error(controller, solution) < 0.1)
+
+
 def plot_blackjack(player, plot_type, action=0):
     """
     Generate a diagram of player's policy or a heatmap of player's value
@@ -363,17 +1222,25 @@ def plot_blackjack(player, plot_type, action=0):
 
 def all_plots(player, name):
     """
-    Make all four plots and save them with the prefix `name`.
+    Make all four plots and save them with the prefix `name`.  A counting
+    player gets a set for each count bucket, named by `bucket_plots`.
     """
+    if getattr(player, 'count_buckets', None) is not None:
+        for snapshot, bucket_name in bucket_plots(player, name):
+            all_plots(snapshot, bucket_name)
+        return
+
     for f in ('policy', 'value'):
         fig, etc = plot_blackjack(player, f)
         fig.savefig('figures/{2}_after_{0}_{1}.pdf'.format(player.nepisodes, f,
             name))
+        pyplot.close(fig)
 
     for f in zip((Const.HIT, Const.STICK), ('hit', 'stick')):
         fig, etc = plot_blackjack(player, 'count', f[0])
         fig.savefig('figures/{2}_after_{0}_counts_{1}.pdf'.format(player.nepisodes,
             f[1], name))
+        pyplot.close(fig)
 
     for t in itertools.product(xrange(*Const.STATE_RANGES[Const.USABLE_ACE]), 
                                xrange(*Const.STATE_RANGES[Const.ACTIONS])):
@@ -381,10 +1248,595 @@ def all_plots(player, name):
             t[0], t[1], name)) 
 
 
-def run_experiment(player, name, plot_points):
-    for p in plot_points: 
-        while player.nepisodes < p:
-            if player.nepisodes % 5000 == 0:
-                print(player.nepisodes)
-            player.run_episode()
-        all_plots(player, name) 
+class Snapshot(collections.namedtuple('Snapshot',
+        'Q Q_count policy nepisodes')):
+    """
+    Copies of a player's tables and episode count, which `all_plots` can
+    plot in place of the player
+    """
+    __slots__ = ()
+    counts = Player.counts.__func__
+
+    @classmethod
+    def of(cls, player):
+        return cls(player.Q.copy(), player.Q_count.copy(),
+                player.policy.copy(), player.nepisodes)
+
+
+def bucket_plots(player, name):
+    """
+    Return the list of (tables, name) pairs that `all_plots` plots for
+    `player`: the player itself, or for a counting player a `Snapshot`
+    view of each count bucket, named `name` + '_bucket_' + the bucket
+    """
+    if getattr(player, 'count_buckets', None) is None:
+        return [(player, name)]
+    return [(Snapshot(Q, Q_count, policy, player.nepisodes),
+        '{0}_bucket_{1}'.format(name, bucket)) for bucket, (Q, Q_count,
+            policy) in enumerate(zip(player.bucket_Q, player.bucket_Q_count,
+                player.bucket_policy))]
+
+
+def render_plots(queue):
+    """
+    Make all plots for each (snapshot, name) taken from `queue`, until
+    None comes out
+    """
+    for snapshot, name in iter(queue.get, None):
+        all_plots(snapshot, name)
+
+
+class Plotter(object):
+    """
+    Make all plots in a separate process, so that episodes can go on while
+    they render.  `plot` queues a `Snapshot` of the player, or of each
+    count bucket of a counting player; at most
+    `maxsize` snapshots wait at once, and `plot` blocks when the queue is
+    full.  `close` waits for the queued plots to finish.  Use as a
+    context manager to close automatically.  If the plotting process
+    dies, `plot` and `close` raise RuntimeError instead of waiting on it
+    forever.
+    """
+
+    def __init__(self, maxsize=2):
+        self.queue = multiprocessing.Queue(maxsize)
+        self.process = multiprocessing.Process(target=render_plots,
+                args=(self.queue,))
+        self.process.start()
+
+    def put(self, item):
+        while True:
+            if not self.process.is_alive():
+                raise RuntimeError("plotting process exited with code {0}"
+                        .format(self.process.exitcode))
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def plot(self, player, name):
+        for tables, plot_name in bucket_plots(player, name):
+            self.put((Snapshot.of(tables), plot_name))
+
+    def close(self):
+        self.put(None)
+        self.process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def test_Plotter():
+    import tempfile, shutil
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        os.chdir(directory)
+        os.mkdir('figures')
+        p = Player('all_pairs', exact_dealer=True)
+        with Plotter(maxsize=1) as plotter:
+            p.run_batch(1000)
+            plotter.plot(p, 'test')
+            p.run_batch(1000) # goes on while the plots render
+            plotter.plot(p, 'test')
+        assert(not plotter.process.is_alive())
+        for nepisodes in (1000, 2000):
+            for f in ('policy', 'value', 'counts_hit', 'counts_stick'):
+                assert(os.path.exists('figures/test_after_{0}_{1}.pdf'.format(
+                    nepisodes, f)))
+        assert(len(os.listdir('figures')) == 2 * (4 + 4))
+
+        # a dead plotting process is reported, not waited on
+        plotter = Plotter(maxsize=1)
+        plotter.process.terminate()
+        plotter.process.join()
+        try:
+            plotter.plot(p, 'test')
+            assert(False)
+        except RuntimeError:
+            pass
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+class Telemetry(collections.namedtuple('Telemetry',
+        'nepisodes policy_flips max_Q_change mean_Q_change unvisited')):
+    """
+    How much a player changed over a window of episodes ending after
+    `nepisodes`: the number of states whose policy flipped, the largest
+    and mean absolute change of Q over all state-action pairs, and the
+    number of state-action pairs never visited so far
+    """
+    __slots__ = ()
+
+
+def window_telemetry(player, Q, policy):
+    """
+    Return the `Telemetry` of `player` since its Q and policy were `Q`
+    and `policy`, lists of the tables in each count bucket as returned by
+    `bucket_tables`.  A counting player's telemetry covers all of its
+    buckets.
+    """
+    Q_change = np.abs([state_values(new) - state_values(old) for new, old
+        in zip(bucket_tables(player, 'Q'), Q)])
+    return Telemetry(player.nepisodes,
+            sum(np.sum(state_values(new) != state_values(old)) for new, old
+                in zip(bucket_tables(player, 'policy'), policy)),
+            Q_change.max(), Q_change.mean(),
+            sum(np.sum(state_values(count) == 0) for count in
+                bucket_tables(player, 'Q_count')))
+
+
+def table_copies(player):
+    """
+    Return copies of `player`'s Q and policy in each count bucket, to
+    pass to `window_telemetry` later
+    """
+    return ([Q.copy() for Q in bucket_tables(player, 'Q')],
+            [policy.copy() for policy in bucket_tables(player, 'policy')])
+
+
+def stable_policy(nwindows=10, max_Q_change=0.01):
+    """
+    Return a stopping rule for `run_experiment` that stops once the
+    policy has not flipped and Q has moved by no more than `max_Q_change`
+    in each of the last `nwindows` windows
+    """
+    def stop(history):
+        recent = history[-nwindows:]
+        return len(recent) == nwindows and all(t.policy_flips == 0 and
+                t.max_Q_change <= max_Q_change for t in recent)
+    return stop
+
+
+def telemetry_arrays(history, prefix=''):
+    """
+    Return a dict of one array per field of a list of `Telemetry`, with
+    `prefix` on each name
+    """
+    return dict((prefix + field, np.array(column, dtype)) for field, column,
+            dtype in zip(Telemetry._fields, zip(*history) or [()] * 5,
+                (int, int, float, float, int)))
+
+
+def telemetry_history(arrays, prefix=''):
+    """
+    Return the list of `Telemetry` in arrays from `telemetry_arrays`
+    """
+    return [Telemetry(*t) for t in zip(*[arrays[prefix + field].tolist()
+        for field in Telemetry._fields])]
+
+
+def save_telemetry(filename, history):
+    """
+    Save a list of `Telemetry` as one compressed array per field
+    """
+    np.savez_compressed(filename, **telemetry_arrays(history))
+
+
+def test_telemetry():
+    p = Player('rnd_pairs')
+    Q, policy = table_copies(p)
+    t = window_telemetry(p, Q, policy)
+    assert(t == (0, 0, 0, 0, 2 * 10 * 10 * 2))
+    p.run_batch(2000)
+    t = window_telemetry(p, Q, policy)
+    assert(t.nepisodes == 2000 and t.policy_flips > 0)
+    assert(0 < t.mean_Q_change < t.max_Q_change <= 1)
+    assert(t.unvisited == np.sum(state_values(p.Q_count) == 0))
+
+    # a counting player's telemetry covers every bucket, not just the last
+    c = Player('rnd_pairs', cards=Shoe(2, seed=3), count_buckets=[-2, 2])
+    Q, policy = table_copies(c)
+    assert(window_telemetry(c, Q, policy).unvisited == 3 * 2 * 10 * 10 * 2)
+    c.run_episodes(3000)
+    ct = window_telemetry(c, Q, policy)
+    assert(ct.unvisited == sum(np.sum(state_values(count) == 0) for count in
+        c.bucket_Q_count))
+    assert(ct.policy_flips == sum(np.sum(state_values(new) !=
+        state_values(old)) for new, old in zip(c.bucket_policy, policy)))
+    assert(ct.policy_flips > np.sum(state_values(c.policy) !=
+        state_values(policy[c.bucket])))
+    assert([name for snapshot, name in bucket_plots(c, 'c')] ==
+            ['c_bucket_0', 'c_bucket_1', 'c_bucket_2'])
+
+    stop = stable_policy(2, max_Q_change=0.1)
+    quiet = Telemetry(1, 0, 0.05, 0.01, 0)
+    assert(not stop([quiet]))
+    assert(not stop([quiet, t]))
+    assert(stop([t, quiet, quiet]))
+
+    import tempfile, os, shutil
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'telemetry.npz')
+        save_telemetry(filename, [t, quiet])
+        saved = np.load(filename)
+        assert((saved['nepisodes'] == [2000, 1]).all())
+        assert(np.allclose(saved['max_Q_change'], [t.max_Q_change, 0.05]))
+    finally:
+        shutil.rmtree(directory)
+
+
+def save_checkpoint(player, filename):
+    """
+    Save everything needed to continue `player`'s run to the compressed
+    file `filename`, which should end in '.npz': its tables, episode
+    count, telemetry and settings, its position in the 'all_pairs' cycle,
+    and the states of the global numpy generator and of its `CardSource`.
+    The tables of every count bucket are saved for a counting player, and
+    the number of decks and penetration for a player dealt from a `Shoe`.
+    The
+    file is written under a temporary name and then renamed over
+    `filename`, so an interrupted save leaves the last checkpoint whole.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    (card_name, card_keys, card_pos, card_has_gauss,
+            card_cached_gaussian), buffer = player.cards.get_state()
+    buckets = {}
+    if player.count_buckets is not None:
+        buckets = dict(count_buckets=player.count_buckets,
+                bucket=player.bucket, bucket_Q=player.bucket_Q,
+                bucket_Q_count=player.bucket_Q_count,
+                bucket_policy=player.bucket_policy)
+    if isinstance(player.cards, Shoe):
+        buckets.update(shoe_ndecks=player.cards.ndecks,
+                shoe_penetration=player.cards.penetration)
+    temporary = filename + '.tmp.npz'
+    np.savez_compressed(temporary, Q=player.Q, Q_count=player.Q_count,
+            policy=player.policy, nepisodes=player.nepisodes,
+            es_strategy=player.es_strategy,
+            exact_dealer=player.exact_dealer,
+            es_position=player.es_position,
+            rng_keys=keys, rng_state=[pos, has_gauss, cached_gaussian],
+            cards_rng_keys=card_keys,
+            cards_rng_state=[card_pos, card_has_gauss, card_cached_gaussian],
+            cards_buffer=np.array(buffer, int),
+            **dict(buckets, **telemetry_arrays(player.telemetry, 'telemetry_')))
+    os.rename(temporary, filename)
+
+
+def load_checkpoint(filename, cards=None):
+    """
+    Rebuild a `Player` from a checkpoint written by `save_checkpoint`, and
+    restore the global numpy generator, so that the player goes on
+    exactly as the saved one would have.  A player that drew from a
+    `Shoe` gets a new shoe with the saved number of decks and
+    penetration.  `cards`, if given, is restored instead, and must be
+    the same kind of cards as the saved ones, or a ValueError is raised.
+    """
+    saved = np.load(filename)
+    if 'shoe_ndecks' in saved:
+        if cards is None:
+            cards = Shoe(int(saved['shoe_ndecks']),
+                    float(saved['shoe_penetration']))
+        elif not (isinstance(cards, Shoe) and
+                cards.ndecks == saved['shoe_ndecks'] and
+                cards.penetration == saved['shoe_penetration']):
+            raise ValueError("checkpoint needs a Shoe of {0} decks at "
+                    "penetration {1}".format(saved['shoe_ndecks'],
+                        saved['shoe_penetration']))
+    elif isinstance(cards, Shoe):
+        raise ValueError("checkpoint was dealt from an infinite deck")
+    if 'count_buckets' in saved:
+        player = Player(str(saved['es_strategy']),
+                bool(saved['exact_dealer']), cards,
+                saved['count_buckets'].tolist())
+        player.bucket_Q = saved['bucket_Q']
+        player.bucket_Q_count = saved['bucket_Q_count']
+        player.bucket_policy = saved['bucket_policy']
+        player.select_bucket(int(saved['bucket']))
+    else:
+        player = Player(str(saved['es_strategy']),
+                bool(saved['exact_dealer']), cards)
+        player.Q = saved['Q']
+        player.Q_count = saved['Q_count']
+        player.policy = saved['policy']
+    player.nepisodes = int(saved['nepisodes'])
+    player.telemetry = telemetry_history(saved, 'telemetry_')
+    player.es_position = int(saved['es_position'])
+    if player.es_strategy == 'all_pairs':
+        player.next_state = player.all_pairs(player.es_position)
+    pos, has_gauss, cached_gaussian = saved['rng_state']
+    np.random.set_state(('MT19937', saved['rng_keys'], int(pos),
+        int(has_gauss), float(cached_gaussian)))
+    pos, has_gauss, cached_gaussian = saved['cards_rng_state']
+    player.cards.set_state((('MT19937', saved['cards_rng_keys'], int(pos),
+        int(has_gauss), float(cached_gaussian)),
+        saved['cards_buffer'].tolist()))
+    return player
+
+
+def test_checkpoint():
+    import tempfile, shutil
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'player.npz')
+        for es_strategy in ('all_pairs', 'rnd_pairs', 'rnd_states'):
+            p = Player(es_strategy, cards=CardSource(seed=3))
+            p.run_episodes(1000, 100)
+            p.run_episodes(37)
+            save_checkpoint(p, filename)
+            p.run_episodes(500)
+            p.run_episodes(500, 100)
+
+            resumed = load_checkpoint(filename)
+            assert(resumed.nepisodes == 1037)
+            resumed.run_episodes(500)
+            resumed.run_episodes(500, 100)
+            assert(resumed.nepisodes == p.nepisodes)
+            assert(resumed.es_position == p.es_position)
+            assert((resumed.Q_count == p.Q_count).all())
+            assert((resumed.Q == p.Q).all())
+            assert((resumed.policy == p.policy).all())
+
+        p = Player('rnd_pairs', cards=Shoe(2, seed=4), count_buckets=[-2, 2])
+        p.run_episodes(1000)
+        save_checkpoint(p, filename)
+        p.run_episodes(1000)
+        for cards in (None, Shoe(2)):
+            resumed = load_checkpoint(filename, cards)
+            assert(isinstance(resumed.cards, Shoe))
+            assert(resumed.cards.size == 104)
+            resumed.run_episodes(1000)
+            assert(resumed.bucket == p.bucket)
+            assert((resumed.bucket_Q == p.bucket_Q).all())
+            assert((resumed.bucket_policy == p.bucket_policy).all())
+        # cards that don't match the saved ones are refused
+        for cards in (Shoe(6), Shoe(2, penetration=0.5), CardSource()):
+            try:
+                load_checkpoint(filename, cards)
+                assert(0)
+            except ValueError:
+                pass
+        assert(os.listdir(directory) == ['player.npz'])
+
+        # a resumed run_experiment carries on the saved telemetry
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            os.mkdir('figures')
+            p = Player('all_pairs', exact_dealer=True)
+            history = run_experiment(p, 'test', [5000], window=1000,
+                    telemetry_file='telemetry.npz', checkpoint_file=filename)
+            resumed = load_checkpoint(filename)
+            assert(resumed.telemetry == history)
+            history = run_experiment(resumed, 'test', [7000], window=1000,
+                    telemetry_file='telemetry.npz', checkpoint_file=filename,
+                    stop=lambda history: len(history) == 6)
+            assert(resumed.telemetry is history)
+            assert((np.load('telemetry.npz')['nepisodes'] ==
+                np.arange(1000, 6001, 1000)).all())
+        finally:
+            os.chdir(cwd)
+    finally:
+        shutil.rmtree(directory)
+
+
+def run_experiment(player, name, plot_points, batch_size=None,
+        solution=None, tolerance=0, window=5000, stop=None,
+        telemetry_file=None, checkpoint_file=None, plotter=None):
+    """
+    Run episodes until each of `plot_points`, making all plots at each.
+    With `batch_size`, episodes are generated `batch_size` at a time by
+    `Player.run_batch`.
+
+    After every `window` episodes, the `Telemetry` of the window is
+    printed and added to the history, and the run stops early if the
+    stopping rule `stop` (see `stable_policy`) returns true for the
+    history so far.  Given the optimal `solution`, the player's error is
+    printed as well, and the run also stops once no more than a
+    `tolerance` fraction of its policy differs.  With `telemetry_file`,
+    the history is saved there with `save_telemetry` at each plot point.
+    With `checkpoint_file`, the player is saved there with
+    `save_checkpoint` after every window; to continue an interrupted run,
+    call this again with the player from `load_checkpoint`.  Given a
+    `Plotter`, plots are made in its process instead of in this one.
+
+    The history is kept in `player.telemetry`, so a run continued on the
+    same player, or on one from `load_checkpoint`, adds to it.  Return
+    the history.
+    """
+    plot = plotter.plot if plotter else all_plots
+    history = player.telemetry
+    Q, policy = table_copies(player)
+    for p in plot_points:
+        done = False
+        while player.nepisodes < p and not done:
+            player.run_episodes(min(window - player.nepisodes % window,
+                p - player.nepisodes), batch_size)
+            if player.nepisodes % window == 0:
+                history.append(window_telemetry(player, Q, policy))
+                Q, policy = table_copies(player)
+                t = history[-1]
+                report = [t.nepisodes, 'policy flips:', t.policy_flips,
+                        'Q change:', t.max_Q_change, t.mean_Q_change,
+                        'unvisited:', t.unvisited]
+                if solution is not None:
+                    error = policy_error(player, solution)
+                    report += ['policy error:', error,
+                            'Q error:', Q_error(player, solution)]
+                    done = error <= tolerance
+                print(*report)
+                done = done or (stop is not None and stop(history))
+                if checkpoint_file is not None:
+                    save_checkpoint(player, checkpoint_file)
+        plot(player, name)
+        if telemetry_file is not None:
+            save_telemetry(telemetry_file, history)
+        if done:
+            break
+    return history
+
+
+def reseed_cards(cards, seed):
+    """
+    Reseed `cards` with `seed` and throw away its buffer, so that a shard
+    draws its own cards and a shoe starts freshly shuffled.  Return
+    `cards`.
+    """
+    cards.random_state.seed(seed)
+    cards.refill()
+    return cards
+
+
+def run_shard(shard):
+    """
+    Run episodes on a local copy of a player's Q, Q_count and policy, and
+    return the local (Q, Q_count).  `shard` is a tuple of the tables, the
+    player's settings, a copy of its `CardSource`, the position of the
+    shard's first episode in the 'all_pairs' cycle, the number of
+    episodes and the seed.
+    """
+    (Q, Q_count, policy, es_strategy, exact_dealer, cards, first_episode,
+            nepisodes, batch_size, seed) = shard
+    np.random.seed(seed)
+    player = Player(es_strategy, exact_dealer, reseed_cards(cards, seed))
+    player.Q, player.Q_count, player.policy = Q, Q_count, policy
+    if es_strategy == 'all_pairs': # pick up the cycle where this shard starts
+        player.next_state = player.all_pairs(first_episode)
+    player.run_episodes(nepisodes, batch_size)
+    return (player.Q, player.Q_count)
+
+
+def merge_shards(player, shards):
+    """
+    Merge the (Q, Q_count) tables of shards that each started from
+    `player`'s tables.  Each shard's new visits are added to the counts,
+    and Q becomes the count-weighted average of every shard's returns.
+    The policy is then made greedy again in every state that was visited.
+    """
+    Q_sum = player.Q * player.Q_count
+    Q_count = player.Q_count.copy()
+    for (shard_Q, shard_Q_count) in shards:
+        Q_sum += shard_Q * shard_Q_count - player.Q * player.Q_count
+        Q_count += shard_Q_count - player.Q_count
+    visited = Q_count > 0
+    player.Q[visited] = Q_sum[visited] / Q_count[visited]
+    changed = (Q_count != player.Q_count).any(-1)
+    player.Q_count = Q_count
+    player.policy[changed] = multimax(player.Q[changed], axis=-1)[1]
+
+
+def train_parallel(player, nepisodes, pool, nworkers, sync_every=10000,
+        batch_size=None, seed=0):
+    """
+    Generate `nepisodes` episodes for `player` on `nworkers` processes of
+    `pool`.  In each round, every worker runs up to `sync_every` episodes
+    against its own copy of the tables, and then the copies are merged
+    with `merge_shards` and the new policy goes out with the next round.
+    Syncing less often costs less but leaves the workers' policies
+    staler.  Round `r` of worker `w` is seeded with `[seed, n, r, w]`,
+    where `n` is the player's episode count when training started.  The
+    workers draw from copies of the player's cards, so a shoe stays a
+    shoe.  Counting players can't be trained in parallel.
+    """
+    if player.count_buckets is not None:
+        raise ValueError("count buckets can't be trained in parallel")
+    start = player.nepisodes
+    nround = 0
+    while player.nepisodes < start + nepisodes:
+        remaining = start + nepisodes - player.nepisodes
+        size = min(sync_every, -(-remaining // nworkers))
+        sizes = [max(0, min(size, remaining - w * size))
+                for w in xrange(nworkers)]
+        shards = [(player.Q, player.Q_count, player.policy,
+            player.es_strategy, player.exact_dealer, player.cards,
+            player.es_position + w * size, n, batch_size,
+            [seed, start, nround, w]) for w, n in enumerate(sizes) if n > 0]
+        merge_shards(player, pool.map(run_shard, shards))
+        player.nepisodes += sum(sizes)
+        if player.es_strategy == 'all_pairs':
+            player.next_state = player.all_pairs(player.es_position +
+                    sum(sizes))
+            player.es_position += sum(sizes)
+        nround += 1
+        print(player.nepisodes)
+
+
+def run_parallel_experiment(player, name, plot_points, processes=None,
+        sync_every=10000, batch_size=None, seed=0, plotter=None):
+    """
+    Like `run_experiment`, but episodes are generated by
+    `train_parallel` on a pool of `processes` workers.
+    """
+    plot = plotter.plot if plotter else all_plots
+    nworkers = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(nworkers)
+    try:
+        for p in plot_points:
+            if player.nepisodes < p:
+                train_parallel(player, p - player.nepisodes, pool, nworkers,
+                        sync_every, batch_size, seed)
+            plot(player, name)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def test_parallel():
+    # merging two shards weights each by its new visits
+    p = Player('rnd_pairs')
+    index = (0, 15, 3, Const.HIT)
+    p.Q[index], p.Q_count[index] = 0.5, 2
+    Q_1, Q_count_1 = p.Q.copy(), p.Q_count.copy()
+    Q_1[index], Q_count_1[index] = 0.0, 4 # two new returns averaging -0.5
+    Q_2, Q_count_2 = p.Q.copy(), p.Q_count.copy()
+    Q_2[index], Q_count_2[index] = 1.0, 3 # one new return of 2
+    merge_shards(p, [(Q_1, Q_count_1), (Q_2, Q_count_2)])
+    assert(p.Q_count[index] == 5)
+    assert(np.isclose(p.Q[index], (0.5 * 2 - 0.5 * 2 + 2) / 5))
+    assert(p.policy[index[:-1]] == Const.HIT)
+
+    pool = multiprocessing.Pool(2)
+    try:
+        p = Player('all_pairs', exact_dealer=True)
+        train_parallel(p, 1000, pool, 2, sync_every=300, batch_size=100)
+        assert(p.nepisodes == 1000)
+        # the workers share out the cycle of start pairs
+        assert((state_values(p.Q_count) > 0).all())
+
+        # and play from the player's shoe, not an infinite deck
+        import pickle
+        p = Player('rnd_pairs', cards=Shoe(ndecks=1, seed=5))
+        p.cards.draw(30)
+        shoe = reseed_cards(pickle.loads(pickle.dumps(p.cards)), [0, 1])
+        assert(isinstance(shoe, Shoe) and shoe.position == 0)
+        assert((shoe.remaining() == p.cards.counts).all())
+        train_parallel(p, 400, pool, 2, batch_size=50)
+        assert(p.nepisodes == 400)
+
+        p = Player('rnd_pairs', cards=Shoe(ndecks=1), count_buckets=[0])
+        try:
+            train_parallel(p, 100, pool, 2)
+            assert(0)
+        except ValueError:
+            pass
+    finally:
+        pool.close()
+        pool.join()
@@ -22,6 +22,7 @@ Functions for experimenting with reinforcement learning in tic-tac-toe.
 
 import random
 import itertools
+import sys
 from functools import partial
 from os import path
 import numpy as np
@@ -30,6 +31,10 @@ import matplotlib
 matplotlib.use('PDF')
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             path.pardir))
+from rlutils import multimax
+
 
 ###############################################################################
 # Simulation components
@@ -39,9 +44,33 @@ BLANK = 0
 X = 1
 O = 2
 
+# outcomes of a board besides a win for X or O
+ONGOING = 0
+DRAW = 3
+
+# place value of each square in a board's base-3 code
+POWERS = [[3**(3*row + col) for col in range(3)] for row in range(3)]
+NSTATES = 3**9
+
+
+def encode(boardstate):
+    """
+    Return the base-3 integer code of a board state matrix: the sum of
+    each square's mark times its place value in `POWERS`
+    """
+    return int((np.asarray(boardstate) * POWERS).sum())
+
+def decode(code):
+    """Return the board state matrix with base-3 integer code `code`"""
+    return nm.matrix([[code // power % 3 for power in row] for row in POWERS],
+                     dtype='int32')
+
 
 class Board():
-    """Tic-tac-toe board.  0 = blank, 1 = 'x', 2 = 'o'"""
+    """
+    Tic-tac-toe board.  0 = blank, 1 = 'x', 2 = 'o'.  `code` is the
+    base-3 integer code of `state`, kept up to date by `play`.
+    """
     rep = {BLANK: ' ', 
            X: 'x', 
            O: 'o'}
@@ -49,6 +78,7 @@ class Board():
     def __init__(self):
         """Initialize board to matrix of BLANKs"""
         self.state = nm.ones([3,3], dtype='int32') * BLANK
+        self.code = 0
     
     def __repr__(self):
         return nm.matrix.__repr__(self.state)
@@ -64,6 +94,7 @@ class Board():
         a tuple, e.g. (0,1).
         """
         self.state[position[0], position[1]] = side
+        self.code += side * POWERS[position[0]][position[1]]
 
 
 def are_winning_rows(boardstate, side):
@@ -95,18 +126,89 @@ def is_draw(boardstate):
     return nm.all(boardstate != 0)
 
 
+# squares, numbered 3*row + col, of each row, column and diagonal
+LINES = [(0, 1, 2), (3, 4, 5), (6, 7, 8),
+         (0, 3, 6), (1, 4, 7), (2, 5, 8),
+         (0, 4, 8), (2, 4, 6)]
+LINES_THROUGH = [[line for line in LINES if square in line]
+                 for square in range(9)]
+
+
+def board_outcomes():
+    """
+    Return an array of the outcome of every board code: X or O if that
+    side has three in a row, DRAW if the board is full, and ONGOING
+    otherwise.  Boards where both sides have three in a row can't be
+    reached, and count as wins for X.
+    """
+    squares = np.arange(NSTATES)[:, np.newaxis] // 3**np.arange(9) % 3
+    outcomes = np.where((squares != BLANK).all(1), DRAW, ONGOING)
+    for side in (O, X):
+        wins = (squares[:, LINES] == side).all(2).any(1)
+        outcomes[wins] = side
+    return outcomes
+
+OUTCOMES = board_outcomes()
+
+
+def is_winning_move(code, side, position):
+    """
+    Return whether `side`, having just played at `position` on the board
+    with code `code`, has won, checking only the lines through
+    `position`
+    """
+    square = 3*position[0] + position[1]
+    for line in LINES_THROUGH[square]:
+        if all(code // 3**s % 3 == side for s in line):
+            return True
+    return False
+
+
+def terminal_values(side):
+    """
+    Return an array of the value to `side` of every board code: 1 if
+    `side` has won, 0 if it has lost or the board is full, and NaN if the
+    game isn't over.
+    """
+    return np.where(OUTCOMES == side, 1,
+                    np.where(OUTCOMES == ONGOING, np.nan, 0))
+
+
+# the 8 rotations and reflections of the board, each as the square every
+# square of the transformed board comes from
+SYMMETRIES = [np.rot90(squares, k).ravel()
+              for squares in (np.arange(9).reshape(3, 3),
+                              np.arange(9).reshape(3, 3).T)
+              for k in range(4)]
+
+
+def canonical_codes():
+    """
+    Return an array of the canonical code of every board code: the
+    smallest code of the board's 8 rotations and reflections
+    """
+    squares = np.arange(NSTATES)[:, np.newaxis] // 3**np.arange(9) % 3
+    return np.min([np.dot(squares[:, symmetry], 3**np.arange(9))
+                   for symmetry in SYMMETRIES], axis=0)
+
+CANONICAL = canonical_codes()
+
+
 class StateValues:
     """
-    Dictionary like structure that maps hashes of board states to
-    probabilities.  __setitem__ should not normally be used.
-    
-    When using __getitem__, if a boardstate hasn't been seen before: for a
-    winning state, a probability of 1 is set before returning, for a losing
-    state, a probability of 0 is set before returning, and for any other
-    unknown state, a value of `default_value` is set before returning.
+    Array of the probabilities of winning from every board state, indexed
+    by the integer codes of board states (see `encode`).  __setitem__
+    should not normally be used.
+
+    Winning states start with a probability of 1, losing states with 0,
+    and any other state with `default_value`.  `visited` marks the states
+    that have been looked up, and len() counts them.
+
+    If `symmetric`, every board is stored under its canonical code (see
+    `CANONICAL`), so that boards that are rotations or reflections of
+    each other share one value.
     """
-    def __init__(self, side, default_value=0.5):
-        self.data = {}
+    def __init__(self, side, default_value=0.5, symmetric=False):
         self.side = side 
         if self.side == X:
             self.opponent = O
@@ -114,27 +216,49 @@ class StateValues:
             self.opponent = X
 
         self.default_value = default_value
+        terminal = terminal_values(side)
+        self.values = np.where(np.isnan(terminal), default_value, terminal)
+        self.visited = np.zeros(NSTATES, bool)
+        self.nvisited = 0
+        self.symmetric = symmetric
 
     def __repr__(self):
-        return self.data.__repr__()
+        codes = np.flatnonzero(self.visited)
+        return dict(zip(codes, self.values[codes])).__repr__()
 
     def __len__(self):
-        return self.data.__len__()
-
-    def __setitem__(self, boardstate, value):
-        self.data[str(boardstate)] = value
+        return self.nvisited
+
+    def visit(self, code):
+        if not self.visited[code]:
+            self.visited[code] = True
+            self.nvisited += 1
+
+    def __setitem__(self, code, value):
+        if self.symmetric:
+            code = CANONICAL[code]
+        self.visit(code)
+        self.values[code] = value
+
+    def __getitem__(self, code):
+        if self.symmetric:
+            code = CANONICAL[code]
+        self.visit(code)
+        return self.values[code]
+
+    def save(self, filename):
+        """
+        Save the values with `np.save`, as one array with NaN for the
+        states that haven't been visited
+        """
+        np.save(filename, np.where(self.visited, self.values, np.nan))
 
-    def __getitem__(self, boardstate):
-        if self.data.has_key(boardstate):
-            pass
-        elif is_winner(boardstate, self.side):
-            self.data[str(boardstate)] = 1
-        elif (is_winner(boardstate, self.opponent) or
-              is_draw(boardstate)):
-            self.data[str(boardstate)] = 0
-        else: # state hasn't been seen and isn't a winner
-            self.data[str(boardstate)] = self.default_value
-        return self.data[str(boardstate)]
+    def load(self, filename):
+        """Load values saved by `save`"""
+        values = np.load(filename)
+        self.visited = ~np.isnan(values)
+        self.nvisited = self.visited.sum()
+        self.values[self.visited] = values[self.visited]
 
 
 class Player():
@@ -143,7 +267,8 @@ class Player():
             default_value=0.5,
             epsilon=0.1,
             alpha=0.9,
-            learn_while_exploring=False):
+            learn_while_exploring=False,
+            symmetric=False):
         """Initialize player.
 
         board := instance of Board class
@@ -153,13 +278,15 @@ class Player():
         epsilon := probability of exploration, (epsilon for
             e-greedy algorithm)
         alpha := learning rate (alpha)
+        symmetric := learn one value for each set of boards that are
+            rotations or reflections of each other
         """
         self.board = board # tic-tac-toe board
         self.side = side # X or O
 
         # Values are probabilites between 0 and 1.  Set value of winning
         # board states to 1, losing states to 0.
-        self.state_values = StateValues(side, default_value)
+        self.state_values = StateValues(side, default_value, symmetric)
         self.exploration_rate = epsilon
         self.learning_rate = alpha
         self.learn_while_exploring = learn_while_exploring
@@ -180,9 +307,8 @@ class Player():
         """
         Return probability of winning if 'position' is the next play made
         """ 
-        test_board = self.board.state.copy()
-        test_board[position[0], position[1]] = self.side
-        return self.state_values[test_board]
+        return self.state_values[self.board.code +
+                                 self.side * POWERS[position[0]][position[1]]]
 
     def new_game(self, board):
         """Reset board"""
@@ -190,17 +316,14 @@ class Player():
 
     def learn(self, chosen_value):
         """Update state value based on chosen state value"""
-        self.state_values[self.board.state] += self.learning_rate * \
-                (chosen_value - self.state_values[self.board.state])
+        self.state_values[self.board.code] += self.learning_rate * \
+                (chosen_value - self.state_values[self.board.code])
 
     def play(self):
         """
         Evaluate choices and make a move.  Update state values.
         """
-        def _find(mat): return [p[0] for p in
-                nm.transpose(nm.nonzero(mat)).tolist()]
-
-        open_positions = _find(self.board.state == BLANK)
+        open_positions = zip(*np.nonzero(np.asarray(self.board.state) == BLANK))
         if self.exploration_rate < 1: # efficiency hack
             values = [self.value(p) for p in open_positions]
         
@@ -210,12 +333,10 @@ class Player():
             if self.learn_while_exploring and self.exploration_rate < 1:
                 self.learn(self.value(chosen_position))
         else: # greedy
-            chosen_value = max(values)
-            # since multiple choices could be equally greedy, we need to
-            # randomly select among them
-            greedy_positions = [pos for (pos, value) in enumerate(values) if
-                    value == chosen_value]
-            chosen_position = open_positions[random.sample(greedy_positions, 1)[0]]
+            # since multiple choices could be equally greedy, multimax
+            # randomly selects among them
+            chosen_value, index = multimax(values)
+            chosen_position = open_positions[index]
             self.learn(chosen_value)
 
         self.board.play(self.side, chosen_position)
@@ -241,13 +362,14 @@ def simulate_game(p1, p2, pause=False, view=False):
         p = player.next()
         take_turn(p, board, pause, view)
         p.record['States Seen'] = len(p1.state_values)
-        if is_winner(board.state, p.side):
+        outcome = OUTCOMES[board.code]
+        if outcome == p.side:
             p.record['Wins'] += 1
             player.next().record['Losses'] += 1
             if view: 
                 print p, "wins!"
             break
-        elif is_draw(board.state):
+        elif outcome == DRAW:
             p1.record['Draws'] += 1
             p2.record['Draws'] += 1
             if view: 
@@ -285,14 +407,17 @@ def run_experiment_decreasing_epsilon(ngames, nruns=1):
 
 def run_experiment(ngames=10, nruns=1, statistic='Wins', default_value=0.5, 
         epsilon_X=0.1, alpha_X=0.9, learn_while_exploring_X=True, 
-        epsilon_O=0.1, alpha_O=0.9, learn_while_exploring_O=True):
+        epsilon_O=0.1, alpha_O=0.9, learn_while_exploring_O=True,
+        symmetric=False):
 
     runs = []
     for _ in xrange(nruns):
         p1 = Player(X, epsilon=epsilon_X, alpha=alpha_X,
-                learn_while_exploring=learn_while_exploring_X)
+                learn_while_exploring=learn_while_exploring_X,
+                symmetric=symmetric)
         p2 = Player(O, epsilon=epsilon_O, alpha=alpha_O,
-                learn_while_exploring=learn_while_exploring_O)
+                learn_while_exploring=learn_while_exploring_O,
+                symmetric=symmetric)
 
         runs.append([(x.record[statistic], o.record[statistic]) for (x, o) in
             simulate_series(p1, p2, ngames)])
@@ -449,14 +574,90 @@ def test_board_states():
     assert(is_draw(b.state))
 
 
+def test_outcomes():
+    for code in xrange(0, NSTATES, 7):
+        boardstate = decode(code)
+        x_wins, o_wins = is_winner(boardstate, X), is_winner(boardstate, O)
+        if x_wins:
+            assert(OUTCOMES[code] == X)
+        elif o_wins:
+            assert(OUTCOMES[code] == O)
+        elif is_draw(boardstate):
+            assert(OUTCOMES[code] == DRAW)
+        else:
+            assert(OUTCOMES[code] == ONGOING)
+
+        # check the lines through each mark as if it was played last
+        for position in zip(*np.nonzero(np.asarray(boardstate))):
+            side = boardstate[position]
+            through = any((np.asarray(boardstate).ravel()[list(line)] ==
+                           side).all() for line in LINES_THROUGH[
+                               3*position[0] + position[1]])
+            assert(is_winning_move(code, side, position) == through)
+
+
+def test_encode():
+    b = Board()
+    b.play(X, (1, 1))
+    b.play(O, (0, 2))
+    assert(b.code == encode(b.state) == 1 * 3**4 + 2 * 3**2)
+    assert((decode(b.code) == b.state).all())
+    codes = set(encode(np.reshape(cells, (3, 3))) for cells in
+                itertools.product((BLANK, X, O), repeat=9))
+    assert(codes == set(range(3**9)))
+
+
 def test_state_values():
     # StateValues tests
     sv = StateValues(X)
-    assert(sv[nm.matrix('1 2 1; 0 0 0; 0 0 0')] == 0.5)
-    assert(sv[nm.matrix('1 2 1; 0 0 0; 0 0 0')] == 0.5)
-    assert(sv[nm.matrix('1 1 1; 0 0 0; 0 0 0')] == 1)
-    assert(sv[nm.matrix('0 1 0; 0 1 0; 0 1 0')] == 1)
-    assert(sv[nm.matrix('0 0 2; 0 2 0; 2 0 0')] == 0)
+    assert(sv[encode(nm.matrix('1 2 1; 0 0 0; 0 0 0'))] == 0.5)
+    assert(sv[encode(nm.matrix('1 2 1; 0 0 0; 0 0 0'))] == 0.5)
+    assert(len(sv) == 1)
+    assert(sv[encode(nm.matrix('1 1 1; 0 0 0; 0 0 0'))] == 1)
+    assert(sv[encode(nm.matrix('0 1 0; 0 1 0; 0 1 0'))] == 1)
+    assert(sv[encode(nm.matrix('0 0 2; 0 2 0; 2 0 0'))] == 0)
+    assert(sv[encode(nm.matrix('1 2 1; 2 2 1; 1 1 2'))] == 0)
+    assert(len(sv) == 5)
+
+    sv[encode(nm.matrix('1 2 1; 0 0 0; 0 0 0'))] = 0.75
+    import tempfile, os, shutil
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'values.npy')
+        sv.save(filename)
+        loaded = StateValues(X)
+        loaded.load(filename)
+        assert(len(loaded) == 5)
+        assert((loaded.visited == sv.visited).all())
+        assert((loaded.values == sv.values).all())
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_symmetry():
+    assert(len(set(CANONICAL)) == 2862)
+    assert((CANONICAL <= np.arange(NSTATES)).all())
+    assert((CANONICAL[CANONICAL] == CANONICAL).all())
+    boardstate = nm.matrix('1 2 0; 0 1 0; 0 0 0')
+    images = [boardstate, np.rot90(boardstate), np.rot90(boardstate, 2),
+              np.rot90(boardstate, 3), boardstate.T, np.fliplr(boardstate),
+              np.flipud(boardstate), np.rot90(boardstate, 2).T]
+    assert(len(set(encode(image) for image in images)) == 8)
+    assert(len(set(CANONICAL[encode(image)] for image in images)) == 1)
+    assert((OUTCOMES[CANONICAL] == OUTCOMES).all())
+
+    sv = StateValues(X, symmetric=True)
+    sv[encode(images[0])] = 0.9
+    assert(all(sv[encode(image)] == 0.9 for image in images))
+    assert(len(sv) == 1)
+
+    pX = Player(X, symmetric=True)
+    pO = Player(O, epsilon=1)
+    for _ in xrange(300):
+        simulate_game(pX, pO)
+    assert(len(pX.state_values) <= 2862)
+    assert((CANONICAL[np.flatnonzero(pX.state_values.visited)] ==
+            np.flatnonzero(pX.state_values.visited)).all())
 
 
 def test_simulate_game(ngames=1000):
@@ -477,5 +678,8 @@ def test_simulate_game(ngames=1000):
 
 def run_tests():
     test_board_states()
+    test_outcomes()
+    test_encode()
     test_state_values()
+    test_symmetry()
     test_simulate_game()